@@ -0,0 +1,71 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ### LLM client reuse benchmark
+# MAGIC Measures the per-request overhead of building a new LLM client for every conversation (the old `ChatBot.__initialize` behavior) against borrowing one from the process-wide `client_pool`.
+
+# COMMAND ----------
+
+# MAGIC %pip install langchain-openai langchain-community mlflow[databricks]
+
+# COMMAND ----------
+
+dbutils.library.restartPython()
+
+# COMMAND ----------
+
+import os
+os.environ['OPENAI_API_KEY'] = dbutils.secrets.get('agent_studio','open_ai')
+os.environ['DATABRICKS_TOKEN'] = dbutils.secrets.get('agent_studio','databricks_token')
+os.environ['DATABRICKS_HOST'] = dbutils.secrets.get('agent_studio','databricks_host')
+
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import HumanMessage
+from Core.ChatConverter import ChatDatabricks_ToolConverter
+from Core.ClientPool import client_pool
+
+model = "gpt-3.5-turbo"
+databricks_model = "databricks-dbrx-instruct"
+iterations = 20
+
+# COMMAND ----------
+
+import time
+import statistics
+
+def time_requests(get_client, send_request, iterations):
+  """Runs iterations requests and returns the per-request latencies in milliseconds."""
+  timings = []
+  for i in range(iterations):
+    start = time.perf_counter()
+    client = get_client()
+    if send_request:
+      client.predict_messages([HumanMessage(content='Reply with the word ok.')])
+    timings.append((time.perf_counter() - start) * 1000)
+  return timings
+
+def summarize(name, timings):
+  timings = sorted(timings)
+  print(f"{name}: mean {statistics.mean(timings):.2f}ms, p50 {timings[len(timings)//2]:.2f}ms, p90 {timings[int(len(timings)*0.9)]:.2f}ms")
+
+# COMMAND ----------
+
+# DBTITLE 1,Client Construction Only
+new_openai = lambda: ChatOpenAI(model = model, openai_api_key=os.environ['OPENAI_API_KEY'])
+pooled_openai = lambda: client_pool.get(('openai', model), new_openai)
+new_databricks = lambda: ChatDatabricks_ToolConverter(target_uri="databricks", endpoint=databricks_model, temperature=0.2)
+pooled_databricks = lambda: client_pool.get(('databricks', databricks_model, 0.2), new_databricks)
+
+client_pool.clear()
+summarize('openai - new client per request', time_requests(new_openai, False, iterations))
+summarize('openai - pooled client', time_requests(pooled_openai, False, iterations))
+summarize('databricks - new client per request', time_requests(new_databricks, False, iterations))
+summarize('databricks - pooled client', time_requests(pooled_databricks, False, iterations))
+
+# COMMAND ----------
+
+# DBTITLE 1,End to End Requests
+# each new client opens a fresh connection (and TLS handshake) to the endpoint; the pooled client keeps its connections alive
+
+client_pool.clear()
+summarize('openai - new client per request', time_requests(new_openai, True, iterations))
+summarize('openai - pooled client', time_requests(pooled_openai, True, iterations))
@@ -0,0 +1,63 @@
+import time
+
+
+class RunBudget():
+  """Tracks the tool rounds, tokens and wall-clock time spent on a single run of the agent loop."""
+
+  def __init__(self, max_tool_rounds = None, max_tokens = None, timeout = None):
+    self.max_tool_rounds = max_tool_rounds
+    self.max_tokens = max_tokens
+    self.timeout = timeout
+
+    self.tool_rounds = 0
+    self.prompt_tokens = 0
+    self.completion_tokens = 0
+    self.start_time = time.monotonic()
+
+  @property
+  def total_tokens(self):
+    return self.prompt_tokens + self.completion_tokens
+
+  def add_round(self):
+    self.tool_rounds += 1
+
+  def add_usage(self, message):
+    prompt_tokens, completion_tokens = token_usage(message)
+    self.prompt_tokens += prompt_tokens
+    self.completion_tokens += completion_tokens
+
+  def elapsed(self):
+    return time.monotonic() - self.start_time
+
+  def remaining_time(self):
+    """Seconds left before the deadline, or None when there is no deadline."""
+    if self.timeout is None:
+      return None
+    return max(0.0, self.timeout - self.elapsed())
+
+  def deadline(self):
+    """The time.monotonic() at which the run times out, or None when there is no deadline."""
+    if self.timeout is None:
+      return None
+    return self.start_time + self.timeout
+
+  def exhausted(self):
+    """Returns the name of the first budget that has run out, or an empty string."""
+    if self.max_tool_rounds is not None and self.tool_rounds >= self.max_tool_rounds:
+      return 'max_tool_rounds'
+    if self.max_tokens is not None and self.total_tokens >= self.max_tokens:
+      return 'max_tokens'
+    if self.timeout is not None and self.elapsed() >= self.timeout:
+      return 'timeout'
+    return ''
+
+
+def token_usage(message):
+  """Returns (prompt_tokens, completion_tokens) reported by the LLM for a response message."""
+  usage = getattr(message, 'usage_metadata', None)
+  if usage:
+    return usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+
+  metadata = getattr(message, 'response_metadata', None) or {}
+  usage = metadata.get('token_usage', metadata.get('usage', None)) or {}
+  return usage.get('prompt_tokens', 0) or 0, usage.get('completion_tokens', 0) or 0
@@ -2,85 +2,282 @@ import json
 import random
 import string
 import ast
-from langchain_core.messages import HumanMessage, ToolMessage, SystemMessage, AIMessage
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from langchain_core.messages import HumanMessage, ToolMessage, SystemMessage, AIMessage, AIMessageChunk
 from langchain_community.chat_models import ChatDatabricks
+from Core.Router import error_status
+from Core.Messages import converted
+
+
+#serving endpoints that take openai style tools natively. Other chat-basic endpoints use the text tool protocol unless
+#native_tools is configured.
+NATIVE_TOOL_ENDPOINTS = ('databricks-meta-llama-3-1', 'databricks-meta-llama-3-3', 'databricks-claude')
 
 
 class ChatDatabricks_ToolConverter(ChatDatabricks):
   def predict_messages(self, messages, tools = []):
-    p = ToolParser()
+    p = tool_parser
     new_messages = p.tools_to_human_ai(messages, tools)
 
     resp = ChatDatabricks.predict_messages(self, new_messages)
     #print(f'LLM Response: {resp}')
     
-    return p.format_response(resp.content)
+    ret = p.format_response(resp.content)
+    #keep the token usage reported by the endpoint
+    ret.response_metadata = resp.response_metadata
+    return ret
 
+  def stream_messages(self, messages, tools = []):
+    """Streams the completion, turning the text tool protocol into answer chunks and tool call chunks as it arrives."""
+    new_messages = tool_parser.tools_to_human_ai(messages, tools)
+
+    parser = StreamingToolParser()
+    metadata, usage = {}, None
+    chunks = ChatDatabricks.stream(self, new_messages)
+    for chunk in chunks:
+      yield from self.__protocol_chunks(parser.feed(chunk.content))
+      metadata.update(chunk.response_metadata)
+      usage = getattr(chunk, 'usage_metadata', None) or usage
+      if parser.finished:
+        #the model moved on from its tool calls to text that isn't used, so stop generating and let the tools run
+        chunks.close()
+        break
+    if not parser.finished:
+      yield from self.__protocol_chunks(parser.close())
+
+    #the token usage and other metadata reported by the endpoint go out once, in a last chunk
+    if usage:
+      yield AIMessageChunk(content = '', response_metadata = metadata, usage_metadata = usage)
+    elif metadata:
+      yield AIMessageChunk(content = '', response_metadata = metadata)
+
+  def __protocol_chunks(self, events):
+    for kind, value in events:
+      if kind == 'text':
+        yield AIMessageChunk(content = value)
+      else:
+        yield AIMessageChunk(content = '', additional_kwargs = {'tool_calls': [value]})
+
+  async def apredict_messages(self, messages, tools = []):
+    p = tool_parser
+    new_messages = p.tools_to_human_ai(messages, tools)
 
+    resp = await ChatDatabricks.apredict_messages(self, new_messages)
 
-class ToolParser():
-  def __init__(self):
+    ret = p.format_response(resp.content)
+    ret.response_metadata = resp.response_metadata
+    return ret
 
-    #self.input = input
-    #self.tools = input.get('tools', [])
-    #self.messages = input['messages']
 
-    self.DEFAULT_INSTRUCTION = 'You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe. Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content. Please ensure that your responses are socially unbiased and positive in nature.\n\nIf a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don\'t know the answer to a question, please don\'t share false information.'
 
-  def format_response(self, response):
-    #print(f'LLM Response: {response}')
+class ChatDatabricks_NativeTools():
+  """Passes tools straight through to a Databricks serving endpoint with native function calling, using its openai
+  compatible API (native is a ChatOpenAI pointed at <host>/serving-endpoints). If the endpoint rejects the tools, this
+  and every later call falls back to the text tool protocol of fallback."""
+
+  def __init__(self, native, fallback):
+    self.native = native
+    self.fallback = fallback
+    self.supported = True
+
+  def __rejected_tools(self, e):
+    if error_status(e) == 400 and 'tool' in str(e).lower():
+      print(f'Endpoint does not support native tools, using the text tool protocol: {e}')
+      self.supported = False
+      return True
+    return False
+
+  def predict_messages(self, messages, tools = None):
+    if self.supported:
+      try:
+        return self.native.predict_messages(messages, tools = tools)
+      except Exception as e:
+        if not self.__rejected_tools(e):
+          raise
+    return self.fallback.predict_messages(messages, tools)
+
+  async def apredict_messages(self, messages, tools = None):
+    if self.supported:
+      try:
+        return await self.native.apredict_messages(messages, tools = tools)
+      except Exception as e:
+        if not self.__rejected_tools(e):
+          raise
+    return await self.fallback.apredict_messages(messages, tools)
+
+  def stream_messages(self, messages, tools = None):
+    if self.supported:
+      try:
+        chunks = iter(self.native.stream(messages, tools = tools))
+        first = next(chunks, None)
+      except Exception as e:
+        if not self.__rejected_tools(e):
+          raise
+      else:
+        if first is not None:
+          yield first
+        yield from chunks
+        return
+    yield from self.fallback.stream_messages(messages, tools)
+
+
+class StreamingToolParser():
+  """Single pass parser for the text tool protocol that consumes a completion as it streams in.
+
+  feed() and close() return events: ('text', answer text) and ('tool_call', openai style tool call with an index).
+  Within the first few characters the parser knows whether the model is answering or calling tools. Answer text,
+  including the content of helper_x--output, is returned as soon as it can't be part of a protocol marker, and each
+  tool call as soon as its closing !> arrives. A completion may hold several tool calls one after another; anything
+  else that follows them is ignored and finished is set. Escaped underscores (\\_) are unescaped on the way."""
+
+  TOOL_START = '<!tool:'
+  OUTPUT_START = '<!tool:helper_x--output###content:'
+  TOOL_END = '!>'
 
-    #clean up the response
-    response = response.strip()
-    cnt = 0
-    while '\_' in response:
-      response = response.replace('\_', '_')
-      cnt+=1
-      if cnt > 100:
+  def __init__(self):
+    self.state = 'start'
+    self.buffer = ''
+    self.backslashes = ''
+    self.tool_calls = 0
+    self.finished = False
+
+  def feed(self, text):
+    text = re.sub(r'\\+_', '_', self.backslashes + text)
+    #a trailing backslash may be escaping an underscore in the next chunk
+    trailing = len(text) - len(text.rstrip('\\'))
+    self.backslashes = text[len(text) - trailing:]
+    self.buffer += text[:len(text) - trailing]
+    return self.__parse(False)
+
+  def close(self):
+    """Call once the completion is complete. Returns the remaining events."""
+    self.buffer += self.backslashes
+    self.backslashes = ''
+    return self.__parse(True)
+
+  def __parse(self, final):
+    events = []
+    while not self.finished:
+      if self.state == 'start':
+        start = self.buffer.lstrip()
+        if start.startswith(self.OUTPUT_START):
+          self.state, self.buffer = 'output', start[len(self.OUTPUT_START):]
+        elif self.OUTPUT_START.startswith(start) and not final:
+          #still could be a tool call or the output tool
+          break
+        elif start.startswith(self.TOOL_START):
+          self.state, self.buffer = 'tool', start[len(self.TOOL_START):]
+        else:
+          self.state, self.buffer = 'answer', start
+
+      elif self.state == 'tool':
+        end = self.buffer.find(self.TOOL_END)
+        if end < 0:
+          if final:
+            raise Exception(f'Invalid LLM output: {self.TOOL_START}{self.buffer}')
+          break
+        events.append(self.__tool_call(self.buffer[:end]))
+        self.state, self.buffer = 'next', self.buffer[end + len(self.TOOL_END):]
+
+      elif self.state == 'next':
+        #after a tool call only another tool call may follow
+        start = self.buffer.lstrip()
+        if start.startswith(self.OUTPUT_START):
+          self.buffer = ''
+          self.finished = True
+        elif self.OUTPUT_START.startswith(start) and not final:
+          #still could be another tool call or the output tool
+          break
+        elif start.startswith(self.TOOL_START):
+          self.state, self.buffer = 'tool', start[len(self.TOOL_START):]
+        else:
+          self.buffer = ''
+          self.finished = True
+
+      elif self.state == 'output':
+        end = self.buffer.find(self.TOOL_END)
+        if end >= 0:
+          text, self.buffer, self.state = self.buffer[:end], self.buffer[end + len(self.TOOL_END):], 'answer'
+        else:
+          hold = 0 if final else self.__partial_marker(self.buffer, [self.TOOL_END])
+          text, self.buffer = self.buffer[:len(self.buffer) - hold], self.buffer[len(self.buffer) - hold:]
+        if text:
+          events.append(('text', text))
+        if end < 0:
+          break
+
+      else:
+        #plain answer, markers of the output tool are dropped
+        self.buffer = self.buffer.replace(self.OUTPUT_START, '').replace(self.TOOL_END, '')
+        hold = 0 if final else self.__partial_marker(self.buffer, [self.OUTPUT_START, self.TOOL_END])
+        text, self.buffer = self.buffer[:len(self.buffer) - hold], self.buffer[len(self.buffer) - hold:]
+        if text:
+          events.append(('text', text))
         break
-    
-    if not response.startswith('<!tool:'):
-      if '<!tool:helper_x--output###content:' in response:
-        response = response.replace('<!tool:helper_x--output###content:', '').replace('!>', '')
-      return AIMessage(content=response)
-    elif response.startswith('<!tool:helper_x--output###content:'):
-      response = response.replace('<!tool:helper_x--output###content:', '').replace('!>', '')
-      return AIMessage(content=response)
-    elif '!>' not in response:
-      raise Exception(f'Invalid LLM output: {response}')
-    
-    start_tool = response.index('<!') + 2    
-    end_tool = response.index('!>')
+    return events
 
-    tool_call = response[start_tool:end_tool].split('###')
+  def __partial_marker(self, text, markers):
+    """Length of the longest end of text that could be the start of one of the markers."""
+    for size in range(min(len(text), max(len(m) for m in markers) - 1), 0, -1):
+      if any(m.startswith(text[-size:]) for m in markers):
+        return size
+    return 0
 
-    tool_name = tool_call[0].split(':')[1]
+  def __tool_call(self, call):
+    tool_call = call.split('###')
+    tool_name = tool_call[0]
 
     args = {}
-
     for arg in tool_call[1:]:
       colon = arg.index(':')
       args[arg[:colon]] = arg[colon+1:]
 
     if tool_name == 'helper_x--output':
-      return AIMessage(content=args['content'])
-    else:
-      kwargs =  {
-        "tool_calls": [
-          {
-            "id": "call_" + ''.join(random.choices(string.ascii_lowercase, k=12)),
-            "type": "function",
-            "function": {
-              "name": tool_name,
-              "arguments": json.dumps(args)
-            }                
-          }
-        ]
+      return ('text', args['content'])
+
+    self.tool_calls += 1
+    return ('tool_call', {
+      "index": self.tool_calls - 1,
+      "id": "call_" + ''.join(random.choices(string.ascii_lowercase, k=12)),
+      "type": "function",
+      "function": {
+        "name": tool_name,
+        "arguments": json.dumps(args)
       }
-      return AIMessage(content='', additional_kwargs = kwargs)
+    })
+
+
+class ToolParser():
+  """Translates between openai style tool calling and the text tool protocol used with chat-basic models. The parser
+  holds no per-conversation state, so a single instance (tool_parser) is shared by every call."""
+
+  MAX_CACHED_PROMPTS = 64
+
+  def __init__(self):
+    #rendered tool prompts by hash of the tool list. The tool list of a deployed agent rarely changes.
+    self.__prompts = OrderedDict()
+    self.lock = threading.Lock()
+
+    #self.input = input
+    #self.tools = input.get('tools', [])
+    #self.messages = input['messages']
+
+    self.DEFAULT_INSTRUCTION = 'You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe. Your answers should not include any harmful, unethical, racist, sexist, toxic, dangerous, or illegal content. Please ensure that your responses are socially unbiased and positive in nature.\n\nIf a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don\'t know the answer to a question, please don\'t share false information.'
+
+  def format_response(self, response):
+    #print(f'LLM Response: {response}')
+    parser = StreamingToolParser()
+    events = parser.feed(response) + parser.close()
+
+    tool_calls = [{k: v for k, v in value.items() if k != 'index'} for kind, value in events if kind == 'tool_call']
+    if len(tool_calls) > 0:
+      return AIMessage(content='', additional_kwargs = {'tool_calls': tool_calls})
+    return AIMessage(content=''.join(value for kind, value in events if kind == 'text').strip())
 
   def tools_to_human_ai(self, messages, tools):
-    messages = [msg.copy() for msg in messages]
     new_messages = []
     if tools is None:
       tools = []
@@ -88,17 +285,28 @@ class ToolParser():
     system_starter = messages[0].content if messages[0].type == 'system' else self.DEFAULT_INSTRUCTION
     new_messages.append(SystemMessage(content = self.__system_message(system_starter, tools)))
 
+    previous = None
     for m in messages:
-      if m.type == 'human':
-        new_messages.append(HumanMessage(content = m.content))
-      elif m.type == 'tool':
-        new_messages.append(self.__parse_tool(m))
-      elif m.type == 'ai':
-        new_messages.append(self.__parse_assistant(m))
-
-    print(new_messages)
+      if m.type == 'tool' and previous == 'tool':
+        #the responses to several tool calls go back as one turn, so user and assistant turns keep alternating
+        new_messages[-1] = HumanMessage(content = new_messages[-1].content + '\n' + self.__converted(m).content)
+      elif m.type in ('human', 'tool', 'ai'):
+        new_messages.append(self.__converted(m))
+      previous = m.type
+
     return new_messages
 
+  def __converted(self, message):
+    #converted forms are kept on the conversation's message records, so later calls only convert the new tail
+    return converted(message, self.__convert)
+
+  def __convert(self, message):
+    if message.type == 'human':
+      return HumanMessage(content = message.content)
+    elif message.type == 'tool':
+      return self.__parse_tool(message)
+    return self.__parse_assistant(message)
+
     
   #def __assistant_starter(self):
   #  return  '```json\n{\n\t"tool_name": "'
@@ -118,9 +326,8 @@ class ToolParser():
       #return f' {content.strip()} {self.eos_token}'
       ret_obj = {"tool_name": "response", "arguments": {"content": content.strip()}}
       #return ' ```json\n{\n\t"tool_name": "response",\n\t"arguments": {"content": "' + content.strip() + '"}\n}\n``` ' + self.eos_token
-    elif len(tool_calls) > 0: #return tool content
-      tool_name = tool_calls[0]["function"]["name"]
-      arguments = json.loads(tool_calls[0]["function"]["arguments"])
+    elif len(tool_calls) > 0: #return tool content, one call after another
+      return AIMessage(content = ''.join(self.__tool_call_str(t) for t in tool_calls))
       #ret_obj = {"tool_name": tool_calls[0]["function"]["name"], "arguments": json.loads(tool_calls[0]["function"]["arguments"])}
 
       #return ' ```json\n{\n\t"tool_name": "' + tool_calls[0]["function"]["name"] + '",\n\t"arguments": ' + str(json.loads(tool_calls[0]["function"]["arguments"])) + '\n}\n``` ' + self.eos_token
@@ -128,17 +335,14 @@ class ToolParser():
       print(content)
       raise Exception("Invalid Assistant Message.")
 
+  def __tool_call_str(self, tool_call):
+    tool_name = tool_call["function"]["name"]
+    arguments = json.loads(tool_call["function"]["arguments"])
+
     arg_str = ""
     for k in arguments.keys():
       arg_str += f"###{k}:{arguments[k]}"
-    ret_str = f"<!tool:{tool_name}{arg_str}!>"
-
-    '''
-    ret_str = '```json\n'
-    ret_str += json.dumps(ret_obj).replace('"tool_name"', '\n\t"tool_name"').replace(' "arguments"', '\n\t"arguments"')[:-1] #format and remove the last character - }
-    ret_str += '\n}\n```'
-    '''
-    return AIMessage(content = ret_str)
+    return f"<!tool:{tool_name}{arg_str}!>"
      
   def __parse_tool(self, message):
     #msg = message.to_json()
@@ -173,7 +377,26 @@ class ToolParser():
 
     return ret
 
+  def tool_prompt(self, tools):
+    """The text the text tool protocol appends to the system prompt for these tools."""
+    return self.__tool_system_message(tools or [])
+
   def __tool_system_message(self, tools):
+    key = hashlib.sha1(json.dumps(tools, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    with self.lock:
+      prompt = self.__prompts.get(key, None)
+      if prompt is not None:
+        self.__prompts.move_to_end(key)
+        return prompt
+
+    prompt = self.__render_tool_system_message(tools)
+    with self.lock:
+      self.__prompts[key] = prompt
+      while len(self.__prompts) > self.MAX_CACHED_PROMPTS:
+        self.__prompts.popitem(last=False)
+    return prompt
+
+  def __render_tool_system_message(self, tools):
 
     tool_list = '\n\n'.join([self.__tool_to_str(tool) for tool in tools])
 
@@ -197,6 +420,12 @@ For example, to use a tool called "helper_0--find_product" with arguments "first
 
 <!tool:helper_0--find_product###first_int:8###second_int:10!>
 
+If you need several tools and the calls don't depend on each other's results, call them all at once by writing the tool calls one after another. For example, to look up two products:
+
+<!tool:helper_0--get_product###name:apple!><!tool:helper_0--get_product###name:pear!>
+
+Each tool's response will be sent back to you. Never combine the helper_x--output tool with other tools.
+
 When responding to the user, you must use this format, using the helper_x--output tool! If you'd like to ask how the user is doing you must write:
 
 <!tool:helper_x--output###content:How are you today?!>
@@ -205,3 +434,6 @@ Remember, you must use one of the tools specified above, and you must start your
 
     return tool_str.format(tool_list=tool_list)
  
+
+
+tool_parser = ToolParser()
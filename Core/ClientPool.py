@@ -0,0 +1,27 @@
+import threading
+
+
+class ClientPool():
+  """Process-wide cache of LLM client objects so conversations reuse their HTTP connection pools and TLS sessions."""
+
+  def __init__(self):
+    self.clients = {}
+    self.lock = threading.Lock()
+
+  def get(self, key, factory):
+    """Returns the client stored under key, building it with factory() the first time it is requested."""
+    client = self.clients.get(key)
+    if client is None:
+      with self.lock:
+        client = self.clients.get(key)
+        if client is None:
+          client = factory()
+          self.clients[key] = client
+    return client
+
+  def clear(self):
+    with self.lock:
+      self.clients = {}
+
+
+client_pool = ClientPool()
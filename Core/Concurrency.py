@@ -0,0 +1,129 @@
+import asyncio
+import collections
+import contextlib
+import threading
+import time
+
+
+class QueueTimeout(TimeoutError):
+  """Raised when no backend slot frees up in time."""
+  pass
+
+
+class BackendLimiter():
+  """Caps the calls in flight to one backend (a SQL warehouse, a Vector Search endpoint, a cluster) across the process.
+
+  Callers that find every slot taken wait in a queue. Freed slots are handed out round robin between owners (the
+  conversations waiting), first come first served within an owner, so one busy conversation can't starve the others."""
+
+  def __init__(self, max_in_flight):
+    self.max_in_flight = max_in_flight
+    self.in_flight = 0
+    self.waiting = collections.OrderedDict()
+    self.condition = threading.Condition()
+
+    self.acquired = 0
+    self.queued = 0
+    self.timeouts = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  def acquire(self, owner, timeout = None):
+    """Waits for a slot. Returns the seconds spent waiting, raises TimeoutError if none frees up within timeout."""
+    start = time.monotonic()
+    with self.condition:
+      if self.in_flight < self.max_in_flight and len(self.waiting) == 0:
+        self.in_flight += 1
+        self.acquired += 1
+        return 0.0
+
+      ticket = {'granted': False}
+      self.waiting.setdefault(owner, collections.deque()).append(ticket)
+      self.queued += 1
+      deadline = start + timeout if timeout is not None else None
+      while not ticket['granted']:
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+          self.__withdraw(owner, ticket)
+          self.timeouts += 1
+          raise QueueTimeout(f'No backend slot freed up within {timeout:.1f}s.')
+        self.condition.wait(remaining)
+
+      waited = time.monotonic() - start
+      self.acquired += 1
+      self.total_wait += waited
+      self.max_wait = max(self.max_wait, waited)
+      return waited
+
+  async def aacquire(self, owner, timeout = None):
+    """Async version of acquire. The wait happens on a worker thread."""
+    future = asyncio.get_running_loop().run_in_executor(None, self.acquire, owner, timeout)
+    try:
+      return await asyncio.shield(future)
+    except asyncio.CancelledError:
+      #the slot may still be granted after the caller gave up, hand it back
+      future.add_done_callback(lambda f: self.release() if not f.cancelled() and f.exception() is None else None)
+      raise
+
+  def release(self):
+    with self.condition:
+      self.in_flight -= 1
+      self.__grant()
+
+  @contextlib.contextmanager
+  def slot(self, owner, timeout = None):
+    waited = self.acquire(owner, timeout)
+    try:
+      yield waited
+    finally:
+      self.release()
+
+  def __grant(self):
+    granted = False
+    while self.in_flight < self.max_in_flight and len(self.waiting) > 0:
+      owner, tickets = self.waiting.popitem(last = False)
+      tickets.popleft()['granted'] = True
+      self.in_flight += 1
+      granted = True
+      if len(tickets) > 0:
+        #the owner goes to the back of the line for its next call
+        self.waiting[owner] = tickets
+    if granted:
+      self.condition.notify_all()
+
+  def __withdraw(self, owner, ticket):
+    tickets = self.waiting.get(owner, None)
+    if tickets is not None and ticket in tickets:
+      tickets.remove(ticket)
+      if len(tickets) == 0:
+        del self.waiting[owner]
+
+  def stats(self):
+    with self.condition:
+      return {
+        'max_in_flight': self.max_in_flight,
+        'in_flight': self.in_flight,
+        'waiting': sum(len(t) for t in self.waiting.values()),
+        'acquired': self.acquired,
+        'queued': self.queued,
+        'timeouts': self.timeouts,
+        'average_wait': self.total_wait / self.queued if self.queued > 0 else 0.0,
+        'max_wait': self.max_wait
+      }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_backend_limiter(key, max_in_flight):
+  """The process-wide BackendLimiter for a backend, shared by every conversation in the process."""
+  with _limiters_lock:
+    if key not in _limiters:
+      _limiters[key] = BackendLimiter(max_in_flight)
+    return _limiters[key]
+
+def backend_limiter_stats():
+  """Queue and wait statistics of every backend limiter, keyed by backend."""
+  with _limiters_lock:
+    limiters = dict(_limiters)
+  return {key: limiter.stats() for key, limiter in limiters.items()}
@@ -0,0 +1,161 @@
+from langchain_core.messages import SystemMessage, ToolMessage, HumanMessage, AIMessage
+
+_encoding = None
+
+def count_text_tokens(text):
+  """Token count of text with the cl100k_base encoding. The encoding is loaded on first use, it may have to be
+  downloaded. If tiktoken or the encoding isn't available, roughly 4 characters per token for english text is used."""
+  global _encoding
+  if _encoding is None:
+    try:
+      import tiktoken
+      _encoding = tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+      print(f'Token counts are estimated, the tiktoken encoding is unavailable: {e}')
+      _encoding = False
+  if _encoding is False:
+    return (len(text) + 3) // 4
+  return len(_encoding.encode(text, disallowed_special=()))
+
+
+class ContextOverflow(ValueError):
+  """Raised when the messages sent to the LLM can't be brought under max_tokens."""
+  pass
+
+
+class ContextWindow():
+  """Decides which part of a conversation is sent to the LLM.
+
+  The system prompt and the last keep_turns turns (a turn starts at each user message) are kept. Older turns are folded
+  into a short summary appended to the system prompt, tool outputs older than the last keep_tool_turns turns are
+  replaced with a marker, and older turns are folded into the summary until the prompt fits in max_tokens. max_tokens is
+  a hard cap that includes the tokens the tool definitions add to the call (overhead_tokens): when the last turn alone
+  is over it, its longest messages are cut, and ContextOverflow is raised if that isn't enough."""
+
+  DROPPED_TOOL_OUTPUT = '[tool output removed to save context]'
+  MESSAGE_OVERHEAD = 4
+
+  def __init__(self, keep_turns = None, max_tokens = None, keep_tool_turns = None, summary_tokens = 500, summarizer = None):
+    self.keep_turns = keep_turns
+    self.max_tokens = max_tokens
+    self.keep_tool_turns = keep_tool_turns
+    self.summary_tokens = summary_tokens
+    self.summarizer = summarizer if summarizer is not None else self.__summarize
+
+  def count_tokens(self, message):
+    """Token count for a single message, including its tool calls."""
+    text = message.content if isinstance(message.content, str) else str(message.content)
+    tool_calls = message.additional_kwargs.get('tool_calls', None)
+    if tool_calls:
+      text += ''.join(t['function']['name'] + t['function']['arguments'] for t in tool_calls)
+    return count_text_tokens(text) + self.MESSAGE_OVERHEAD
+
+  def total_tokens(self, messages):
+    return sum(self.count_tokens(m) for m in messages)
+
+  def apply(self, messages, overhead_tokens = 0):
+    """Returns the messages to send to the LLM. The input list is not modified. overhead_tokens is what the call adds
+    on top of the messages, such as the tool definitions, and counts against max_tokens."""
+    if len(messages) == 0:
+      return messages
+
+    system = messages[0] if messages[0].type == 'system' else None
+    turns = self.__split_turns(messages[1:] if system is not None else messages)
+
+    older = []
+    if self.keep_turns is not None and len(turns) > self.keep_turns:
+      split = len(turns) - max(1, self.keep_turns)
+      older, turns = turns[:split], turns[split:]
+
+    if self.keep_tool_turns is not None:
+      stale = len(turns) - max(1, self.keep_tool_turns)
+      turns = [self.__drop_tool_outputs(t) if i < stale else t for i, t in enumerate(turns)]
+
+    if self.max_tokens is None:
+      return self.__build(system, older, turns)
+
+    #each message is tokenized once. While turns are folded, the summary is counted at its summary_tokens budget.
+    limit = self.max_tokens - overhead_tokens
+    fixed = self.count_tokens(system) if system is not None else 0
+    turn_counts = [[self.count_tokens(m) for m in t] for t in turns]
+    while len(turns) > 1 and fixed + (self.summary_tokens if len(older) > 0 else 0) + sum(map(sum, turn_counts)) > limit:
+      older.append(turns.pop(0))
+      turn_counts.pop(0)
+
+    window = self.__build(system, older, turns)
+    #the system message (with the summary) is counted again, the turns kept their counts
+    head = len(window) - sum(len(t) for t in turns)
+    counts = [self.count_tokens(m) for m in window[:head]]
+    for c in turn_counts:
+      counts.extend(c)
+    if sum(counts) > limit:
+      window = self.__trim(window, counts, limit, ('tool',))
+    if sum(counts) > limit:
+      #the last turn alone is too long, so the user and assistant messages are cut as well
+      window = self.__trim(window, counts, limit, ('tool', 'human', 'ai'))
+    if sum(counts) > limit:
+      raise ContextOverflow(f'The messages need {sum(counts)} tokens after trimming and the tools {overhead_tokens}, '
+                            f'more than max_context_tokens ({self.max_tokens}).')
+    return window
+
+  def __split_turns(self, messages):
+    turns = []
+    for m in messages:
+      if m.type == 'human' or len(turns) == 0:
+        turns.append([])
+      turns[-1].append(m)
+    return turns
+
+  def __drop_tool_outputs(self, turn):
+    return [ToolMessage(content = self.DROPPED_TOOL_OUTPUT, name = m.name, tool_call_id = m.tool_call_id) if m.type == 'tool' else m for m in turn]
+
+  def __build(self, system, older, turns):
+    window = []
+    if len(older) > 0:
+      summary = self.summarizer(older)
+      content = system.content if system is not None else ''
+      window.append(SystemMessage(content = f'{content}\n\nSummary of the earlier conversation:\n{summary}'.strip()))
+    elif system is not None:
+      window.append(system)
+
+    for t in turns:
+      window.extend(t)
+    return window
+
+  def __summarize(self, turns):
+    """Extractive summary of the user requests and assistant answers, newest first until summary_tokens is reached."""
+    lines = []
+    budget = self.summary_tokens
+    for turn in reversed(turns):
+      for m in reversed(turn):
+        if m.type not in ('human', 'ai') or not m.content:
+          continue
+        line = f"{'User' if m.type == 'human' else 'Assistant'}: {m.content.strip()}"
+        tokens = count_text_tokens(line)
+        if tokens > budget:
+          return '\n'.join(reversed(lines))
+        budget -= tokens
+        lines.append(line)
+    return '\n'.join(reversed(lines))
+
+  def __trim(self, window, counts, limit, types):
+    """Halves the largest remaining messages of the given types until the window fits in limit. counts holds the
+    token count of each message of the window and is kept up to date."""
+    window = list(window)
+    while sum(counts) > limit:
+      long = [i for i, m in enumerate(window) if m.type in types and isinstance(m.content, str) and len(m.content) > 200]
+      if len(long) == 0:
+        break
+      i = max(long, key = lambda i: len(window[i].content))
+      m = window[i]
+      keep = len(m.content) // 2
+      window[i] = self.__with_content(m, f'{m.content[:keep]}\n[{len(m.content) - keep} characters removed to save context]')
+      counts[i] = self.count_tokens(window[i])
+    return window
+
+  def __with_content(self, message, content):
+    if message.type == 'tool':
+      return ToolMessage(content = content, name = message.name, tool_call_id = message.tool_call_id)
+    if message.type == 'human':
+      return HumanMessage(content = content)
+    return AIMessage(content = content, additional_kwargs = message.additional_kwargs)
@@ -0,0 +1,260 @@
+try:
+  from databricks.sdk.runtime import *
+except ImportError:
+  pass
+
+import atexit
+import datetime
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+from Core.Profiling import Tracer
+
+
+#compact row written for every message of a conversation
+LOG_COLUMNS = ['conversation_id', 'ordinal_position', 'role', 'content', 'name', 'tool_call_id', 'tool_calls', 'created_date', 
+               'model', 'prompt_tokens', 'completion_tokens', 'cost']
+LOG_SCHEMA = 'conversation_id string, ordinal_position int, role string, content string, name string, tool_call_id string, tool_calls string, created_date timestamp, ' \
+             'model string, prompt_tokens int, completion_tokens int, cost double'
+
+
+def log_row(conversation_id, ordinal_position, output_message, created_date, usage = None):
+  """Builds a log row from a message translated to the openai dict format. usage is set on assistant messages produced by an LLM call."""
+  tool_calls = output_message.get('tool_calls', None)
+  usage = usage or {}
+  return {
+    'conversation_id': conversation_id,
+    'ordinal_position': ordinal_position,
+    'role': output_message.get('role', ''),
+    'content': output_message.get('content', ''),
+    'name': output_message.get('name', None),
+    'tool_call_id': output_message.get('tool_call_id', None),
+    'tool_calls': json.dumps(tool_calls) if tool_calls else None,
+    'created_date': created_date,
+    'model': usage.get('model', None),
+    'prompt_tokens': usage.get('prompt_tokens', None),
+    'completion_tokens': usage.get('completion_tokens', None),
+    'cost': usage.get('cost', None)
+  }
+
+
+def spark_available():
+  return globals().get('spark', None) is not None
+
+
+class LogSink():
+  """Destination for conversation log rows. write() is only called from the logger's background thread."""
+
+  def write(self, rows):
+    raise NotImplementedError()
+
+  def close(self):
+    pass
+
+
+class SparkTableSink(LogSink):
+  """Appends log rows to a Delta table. Requires a spark session."""
+
+  def __init__(self, table_name):
+    self.table_name = table_name
+
+  def write(self, rows):
+    data = [tuple(r[c] for c in LOG_COLUMNS) for r in rows]
+    df = spark.createDataFrame(data, schema=LOG_SCHEMA)
+    df.write.mode('append').option('mergeSchema', 'true').saveAsTable(self.table_name)
+
+
+class LocalFileSink(LogSink):
+  """Appends log rows to rotating JSONL or Parquet files in a local (or FUSE mounted) directory.
+
+  The file being written starts with an underscore so readers such as spark skip it. It is renamed once it reaches
+  max_file_rows rows, is older than max_file_age seconds, or the sink is closed. Compression is gzip (or None) for
+  jsonl and any codec pyarrow supports for parquet."""
+
+  def __init__(self, directory, file_format = 'jsonl', compression = 'gzip', max_file_rows = 100000, max_file_age = 3600):
+    if file_format not in ('jsonl', 'parquet'):
+      raise ValueError(f'Unsupported log file format: {file_format}')
+    self.directory = directory
+    self.file_format = file_format
+    self.compression = compression
+    self.max_file_rows = max_file_rows
+    self.max_file_age = max_file_age
+
+    self.__file = None
+    self.__path = None
+    self.__rows = 0
+    self.__opened = 0
+    self.__sequence = 0
+    os.makedirs(directory, exist_ok=True)
+
+  def write(self, rows):
+    if self.__file is not None and (self.__rows >= self.max_file_rows or time.monotonic() - self.__opened >= self.max_file_age):
+      self.__rotate()
+    if self.__file is None:
+      self.__open()
+
+    if self.file_format == 'parquet':
+      import pyarrow as pa
+      self.__file.write_table(pa.Table.from_pylist(rows, schema=self.__arrow_schema()))
+    else:
+      self.__file.write(''.join(json.dumps(r, default=self.__json_default) + '\n' for r in rows).encode('utf-8'))
+      self.__file.flush()
+    self.__rows += len(rows)
+
+  def close(self):
+    self.__rotate()
+
+  def __open(self):
+    self.__sequence += 1
+    stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    extension = 'parquet' if self.file_format == 'parquet' else ('jsonl.gz' if self.compression == 'gzip' else 'jsonl')
+    self.__path = os.path.join(self.directory, f'_conversations-{stamp}-{os.getpid()}-{self.__sequence}.{extension}')
+
+    if self.file_format == 'parquet':
+      import pyarrow.parquet as pq
+      self.__file = pq.ParquetWriter(self.__path, self.__arrow_schema(), compression = self.compression or 'none')
+    elif self.compression == 'gzip':
+      self.__file = gzip.open(self.__path, 'ab')
+    else:
+      self.__file = open(self.__path, 'ab')
+    self.__rows = 0
+    self.__opened = time.monotonic()
+
+  def __rotate(self):
+    if self.__file is None:
+      return
+    self.__file.close()
+    self.__file = None
+    #drop the underscore so loaders pick the finished file up
+    os.rename(self.__path, os.path.join(self.directory, os.path.basename(self.__path)[1:]))
+
+  def __arrow_schema(self):
+    import pyarrow as pa
+    return pa.schema([('conversation_id', pa.string()), ('ordinal_position', pa.int32()), ('role', pa.string()), 
+                      ('content', pa.string()), ('name', pa.string()), ('tool_call_id', pa.string()), 
+                      ('tool_calls', pa.string()), ('created_date', pa.timestamp('us')), ('model', pa.string()), 
+                      ('prompt_tokens', pa.int32()), ('completion_tokens', pa.int32()), ('cost', pa.float64())])
+
+  def __json_default(self, value):
+    if isinstance(value, datetime.datetime):
+      return value.isoformat()
+    return str(value)
+
+
+def load_log_files(directory, output_table, file_format = 'jsonl', archive_directory = None):
+  """Bulk loads finished log files written by LocalFileSink into a Delta table. Run this from a notebook or job.
+
+  Loaded files are moved to archive_directory (default: a loaded folder inside directory) so they are not loaded twice."""
+  suffixes = ('.parquet',) if file_format == 'parquet' else ('.jsonl', '.jsonl.gz')
+  files = [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.startswith('conversations-') and f.endswith(suffixes)]
+  if len(files) == 0:
+    return 0
+
+  reader = spark.read.schema(LOG_SCHEMA)
+  df = reader.parquet(*files) if file_format == 'parquet' else reader.json(files)
+  count = df.count()
+  df.write.mode('append').option('mergeSchema', 'true').saveAsTable(output_table)
+
+  archive_directory = archive_directory or os.path.join(directory, 'loaded')
+  os.makedirs(archive_directory, exist_ok=True)
+  for f in files:
+    os.rename(f, os.path.join(archive_directory, os.path.basename(f)))
+
+  print(f'Loaded {count} rows from {len(files)} files into {output_table}')
+  return count
+
+
+class ConversationLogger():
+  """Queues log rows on the request path and writes them to a sink in batches from a background thread.
+
+  A batch is written once batch_size rows are waiting or flush_interval seconds have passed. The queue holds at most
+  max_queue rows; when it is full log() waits up to put_timeout seconds per row and then drops the row."""
+
+  def __init__(self, sink, batch_size = 500, flush_interval = 30, max_queue = 10000, put_timeout = 0.05):
+    self.sink = sink
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.put_timeout = put_timeout
+    self.queue = queue.Queue(maxsize = max_queue)
+    self.dropped = 0
+    self.written = 0
+    self.tracer = Tracer()
+
+    self.__flush_requested = threading.Event()
+    self.__stopped = threading.Event()
+    self.__thread = threading.Thread(target = self.__run, name = 'conversation-logger', daemon = True)
+    self.__thread.start()
+    atexit.register(self.close)
+
+  def log(self, rows):
+    for row in rows:
+      try:
+        self.queue.put(row, timeout = self.put_timeout)
+      except queue.Full:
+        self.dropped += 1
+
+  def flush(self):
+    """Asks the background thread to write everything queued so far."""
+    self.__flush_requested.set()
+
+  def close(self, timeout = 30):
+    """Writes the remaining rows and stops the background thread."""
+    if self.__stopped.is_set():
+      return
+    self.__stopped.set()
+    self.__flush_requested.set()
+    self.__thread.join(timeout)
+    self.sink.close()
+
+  def __run(self):
+    batch = []
+    deadline = time.monotonic() + self.flush_interval
+    while True:
+      try:
+        batch.append(self.queue.get(timeout = max(0.0, min(deadline - time.monotonic(), 0.5))))
+      except queue.Empty:
+        pass
+
+      stopping = self.__stopped.is_set()
+      if len(batch) >= self.batch_size or time.monotonic() >= deadline or self.__flush_requested.is_set():
+        #drain whatever else is already waiting before writing
+        while len(batch) < self.batch_size or stopping:
+          try:
+            batch.append(self.queue.get_nowait())
+          except queue.Empty:
+            break
+        self.__write(batch)
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        if self.queue.empty():
+          self.__flush_requested.clear()
+
+      if stopping and self.queue.empty() and len(batch) == 0:
+        return
+
+  def __write(self, batch):
+    if len(batch) == 0:
+      return
+    try:
+      with self.tracer.span('log_flush', type(self.sink).__name__, rows = len(batch), queued = self.queue.qsize(), dropped = self.dropped):
+        self.sink.write(batch)
+      self.written += len(batch)
+    except Exception as e:
+      print(f'Failed to write {len(batch)} conversation log rows: {e}')
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+def get_logger(key, create):
+  """Returns the process-wide logger for key, creating it with create() the first time."""
+  with _loggers_lock:
+    logger = _loggers.get(key)
+    if logger is None:
+      logger = create()
+      _loggers[key] = logger
+    return logger
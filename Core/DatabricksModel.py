@@ -22,6 +22,34 @@ class ChatModel(mlflow.pyfunc.PythonModel):
     self.route = config.get('route', '')
     self.instruction_prompt = config.get('instruction_prompt', 'You are an assistant.')
     self.log_directory = config.get('log_directory', '')
+    self.max_tool_rounds = config.get('max_tool_rounds', 10)
+    self.max_tokens = config.get('max_tokens', None)
+    self.request_timeout = config.get('request_timeout', None)
+    self.max_tool_workers = config.get('max_tool_workers', 32)
+    self.tool_timeout = config.get('tool_timeout', None)
+    self.tool_timeouts = config.get('tool_timeouts', {})
+    self.circuit_breaker = config.get('circuit_breaker', {})
+    self.context_keep_turns = config.get('context_keep_turns', None)
+    self.max_context_tokens = config.get('max_context_tokens', None)
+    self.context_keep_tool_turns = config.get('context_keep_tool_turns', None)
+    self.tool_output_max_tokens = config.get('tool_output_max_tokens', None)
+    self.tool_output_limits = config.get('tool_output_limits', {})
+    self.tool_cache_ttls = config.get('tool_cache_ttls', {})
+    self.log_format = config.get('log_format', 'jsonl')
+    self.log_compression = config.get('log_compression', 'gzip')
+    self.profiling_callbacks = config.get('profiling_callbacks', [])
+    self.providers = config.get('providers', [])
+    self.routing_strategy = config.get('routing_strategy', 'ordered')
+    self.llm_timeout = config.get('llm_timeout', None)
+    self.hedge_after = config.get('hedge_after', None)
+    self.max_llm_workers = config.get('max_llm_workers', 64)
+    self.llm_retry = config.get('llm_retry', {})
+    self.llm_requests_per_minute = config.get('llm_requests_per_minute', None)
+    self.prices = config.get('prices', {})
+    self.tool_selection = config.get('tool_selection', None)
+    self.max_backend_calls = config.get('max_backend_calls', None)
+    self.backend_limits = config.get('backend_limits', {})
+    self.native_tools = config.get('native_tools', None)
 
   def load_context(self, context):
     config = {
@@ -29,7 +57,35 @@ class ChatModel(mlflow.pyfunc.PythonModel):
       "provider": self.provider,
       "model": self.model,
       "endpoint_type": self.endpoint_type,
-      "log_directory": self.log_directory
+      "log_directory": self.log_directory,
+      "max_tool_rounds": self.max_tool_rounds,
+      "max_tokens": self.max_tokens,
+      "request_timeout": self.request_timeout,
+      "max_tool_workers": self.max_tool_workers,
+      "tool_timeout": self.tool_timeout,
+      "tool_timeouts": self.tool_timeouts,
+      "circuit_breaker": self.circuit_breaker,
+      "context_keep_turns": self.context_keep_turns,
+      "max_context_tokens": self.max_context_tokens,
+      "context_keep_tool_turns": self.context_keep_tool_turns,
+      "tool_output_max_tokens": self.tool_output_max_tokens,
+      "tool_output_limits": self.tool_output_limits,
+      "tool_cache_ttls": self.tool_cache_ttls,
+      "log_format": self.log_format,
+      "log_compression": self.log_compression,
+      "profiling_callbacks": self.profiling_callbacks,
+      "providers": self.providers,
+      "routing_strategy": self.routing_strategy,
+      "llm_timeout": self.llm_timeout,
+      "hedge_after": self.hedge_after,
+      "max_llm_workers": self.max_llm_workers,
+      "llm_retry": self.llm_retry,
+      "llm_requests_per_minute": self.llm_requests_per_minute,
+      "prices": self.prices,
+      "tool_selection": self.tool_selection,
+      "max_backend_calls": self.max_backend_calls,
+      "backend_limits": self.backend_limits,
+      "native_tools": self.native_tools
     }
     self.bot = ChatBot(config, self.helpers)
 
@@ -51,19 +107,68 @@ class ChatModel(mlflow.pyfunc.PythonModel):
     return input_list[0]
   
   def predict(self, context, model_input, params):
-    input_fields = self.get_input(model_input)
+    input_fields = self.__input_fields(model_input)
     #return messages
 
-    if isinstance(input_fields, str):
-      input_fields = eval(input_fields)
+    if input_fields.get('feedback', False):
+      return {}
+
+    #each request gets its own conversation state, the bot is shared
+    conversation = self.bot.start_conversation(input_fields['messages'])
+    response = self.bot.run_conversation(conversation)
+
+    return self.__output(conversation, response)
+
+  async def apredict(self, context, model_input, params = None):
+    """Async version of predict, so many conversations can be awaited at once."""
+    input_fields = self.__input_fields(model_input)
 
     if input_fields.get('feedback', False):
       return {}
 
-    response = self.bot.run_thread(input_fields['messages'])
+    conversation = self.bot.start_conversation(input_fields['messages'])
+    response = await self.bot.arun_conversation(conversation)
+
+    return self.__output(conversation, response)
+
+  def predict_stream(self, context, model_input, params = None):
+    """Streaming version of predict. Yields tool call progress events and then the answer tokens as chat completion chunks."""
+    input_fields = self.__input_fields(model_input)
+
+    if input_fields.get('feedback', False):
+      return
+
+    conversation = self.bot.start_conversation(input_fields['messages'])
+    for event in self.bot.stream_conversation(conversation):
+      if event['type'] == 'token':
+        yield {
+          'run_id': conversation.conversation_id,
+          'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': event['content']}}]
+        }
+      elif event['type'] == 'done':
+        yield {
+          'run_id': conversation.conversation_id,
+          'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+          'thread': conversation.output_thread(),
+          'usage': conversation.usage.summary()
+        }
+      else:
+        yield {
+          'run_id': conversation.conversation_id,
+          'event': event
+        }
+
+  def __input_fields(self, model_input):
+    input_fields = self.get_input(model_input)
+
+    if isinstance(input_fields, str):
+      input_fields = eval(input_fields)
+
+    return input_fields
 
+  def __output(self, conversation, response):
     output = {
-      'run_id': self.bot.conversation_id,
+      'run_id': conversation.conversation_id,
       'choices': [
         {
           'index': 0,
@@ -73,7 +178,8 @@ class ChatModel(mlflow.pyfunc.PythonModel):
           }
         }
       ],
-      'thread': self.bot.output_thread()
+      'thread': conversation.output_thread(),
+      'usage': conversation.usage.summary()
     }
 
     return output
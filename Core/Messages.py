@@ -0,0 +1,162 @@
+import contextlib
+import contextvars
+import datetime
+import uuid
+
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+
+from Core.Usage import Usage
+
+
+def to_openai(msg):
+    """Translates a langchain message to the openai dict format."""
+    if msg.type == 'system':
+        #system
+        return {
+            'role': 'system',
+            'content': msg.content
+        }
+    elif msg.type == 'human':
+        #user
+        return {
+            'role': 'user',
+            'content': msg.content
+        }
+    elif msg.type == 'ai':
+        #assistant
+        ret = {
+            'role': 'assistant',
+            'content': msg.content
+        }
+        tools = msg.additional_kwargs.get('tool_calls', None)
+        if tools:
+            ret['tool_calls'] = tools
+        return ret
+    elif msg.type == 'tool':
+        #tool
+        return {
+            "role": "tool",
+            "tool_call_id": msg.tool_call_id,
+            "name": msg.name,
+            "content": msg.content
+        }
+
+    return {}
+
+
+def normalize(msg):
+    """Reads a message sent by a client (openai or langchain style dict) into the openai dict format. Returns None for unsupported roles."""
+    tp = msg.get('type', 'user')
+    role = msg.get('role', tp)
+
+    if role == 'human' or role == 'user':
+        return {'role': 'user', 'content': msg.get('content', '')}
+    elif role == 'ai' or role == 'assistant':
+        tools = msg.get('tool_calls', [])
+        tools = msg.get('additional_kwargs', {}).get('tool_calls', tools)
+        ret = {'role': 'assistant', 'content': msg.get('content', '')}
+        if tools:
+            ret['tool_calls'] = tools
+        return ret
+    elif role == 'tool':
+        return {"role": "tool", "tool_call_id": msg.get('tool_call_id', ''), "name": msg.get('name', ''), "content": msg.get('content', '')}
+    return None
+
+
+def to_langchain(msg):
+    """Translates a message in the openai dict format to a langchain message."""
+    role = msg['role']
+    if role == 'system':
+        return SystemMessage(content = msg['content'])
+    elif role == 'user':
+        return HumanMessage(content = msg['content'])
+    elif role == 'assistant':
+        tools = msg.get('tool_calls', None)
+        return AIMessage(content = msg['content'], additional_kwargs = { 'tool_calls' : tools } if tools else {})
+    elif role == 'tool':
+        return ToolMessage(content = msg['content'], name = msg['name'], tool_call_id = msg['tool_call_id'])
+    raise ValueError(f'Unsupported message role: {role}')
+
+
+class MessageRecord():
+    """A message of a conversation. It is stored in whichever format it arrived in (langchain or openai dict) and
+    translated to the other format on first use, after which both are kept. Both formats share the same content strings."""
+
+    __slots__ = ['ordinal_position', 'created_date', 'logged', 'usage', 'converted', '_message', '_openai']
+
+    def __init__(self, ordinal_position, message = None, openai = None, usage = None):
+        self.ordinal_position = ordinal_position
+        self.created_date = datetime.datetime.now()
+        self.logged = False
+        #token usage of the LLM call that produced an assistant message
+        self.usage = usage
+        #the message as sent to models that use the text tool protocol, see converted()
+        self.converted = None
+        self._message = message
+        self._openai = openai
+
+    @property
+    def message(self):
+        """The langchain message."""
+        if self._message is None:
+            self._message = to_langchain(self._openai)
+        return self._message
+
+    @property
+    def openai(self):
+        """The message in the openai dict format."""
+        if self._openai is None:
+            self._openai = to_openai(self._message)
+        return self._openai
+
+
+class Conversation():
+    """The messages of one conversation. Each request works on its own Conversation, so a ChatBot can serve many at once."""
+
+    __slots__ = ['conversation_id', 'records', 'usage']
+
+    def __init__(self, conversation_id = None):
+        self.conversation_id = conversation_id if conversation_id is not None else str(uuid.uuid4())
+        self.records = []
+        self.usage = Usage()
+
+    def add(self, message, usage = None):
+        """Adds a langchain message."""
+        self.records.append(MessageRecord(len(self.records) + 1, message = message, usage = usage))
+
+    def add_openai(self, msg):
+        """Adds a message in the openai dict format."""
+        self.records.append(MessageRecord(len(self.records) + 1, openai = msg))
+
+    @property
+    def messages(self):
+        """The conversation as langchain messages."""
+        return [r.message for r in self.records]
+
+    def output_thread(self):
+        return [r.openai for r in self.records]
+
+
+_records = contextvars.ContextVar('conversation_records', default = None)
+
+@contextlib.contextmanager
+def conversation_scope(conversation):
+    """While active, converted() keeps the converted forms of the conversation's messages on their records, so an LLM
+    client converting the thread only converts the messages added since its last call. They are freed with the conversation."""
+    token = _records.set({id(r.message): r for r in conversation.records})
+    try:
+        yield
+    finally:
+        _records.reset(token)
+
+
+def converted(message, convert):
+    """Returns convert(message), kept on the message's MessageRecord when called within a conversation_scope. Messages
+    that aren't records of the conversation (such as trimmed copies made for the context window) are converted each time."""
+    records = _records.get()
+    record = records.get(id(message), None) if records is not None else None
+    if record is None:
+        return convert(message)
+    if record.converted is None:
+        record.converted = convert(message)
+    return record.converted
@@ -0,0 +1,121 @@
+import ast
+import json
+
+from Core.Context import count_text_tokens
+
+
+class OutputShaper():
+  """Fits tool outputs into a token budget before they are added to the conversation.
+
+  Pipe delimited tables keep their header and the first and last rows, JSON (or python literal) outputs are projected
+  onto the configured fields and have long lists and strings shortened, and anything else keeps its head and tail.
+  Every cut leaves a marker saying what was removed.
+
+  tool_limits maps a function name (with or without the helper_<index>-- prefix) to a dict with max_tokens and
+  optionally fields, the top level keys to keep from a JSON output."""
+
+  TAIL_SHARE = 4 #one row in four kept from the end
+
+  def __init__(self, max_tokens = None, tool_limits = {}):
+    self.max_tokens = max_tokens
+    self.tool_limits = tool_limits
+
+  def limits(self, tool_name):
+    short_name = tool_name.split('--')[-1]
+    limits = self.tool_limits.get(tool_name, self.tool_limits.get(short_name, {}))
+    return limits.get('max_tokens', self.max_tokens), limits.get('fields', None)
+
+  def shape(self, tool_name, output):
+    if not isinstance(output, str):
+      output = str(output)
+
+    max_tokens, fields = self.limits(tool_name)
+    if max_tokens is None and fields is None:
+      return output
+
+    value = self.__parse_structured(output)
+    if value is not None and fields is not None and isinstance(value, dict):
+      value = {k: v for k, v in value.items() if k in fields}
+      output = json.dumps(value, default=str)
+
+    if max_tokens is None or count_text_tokens(output) <= max_tokens:
+      return output
+
+    if value is not None:
+      output = self.__shape_structured(value, max_tokens)
+      if count_text_tokens(output) <= max_tokens:
+        return output
+    elif self.__is_table(output):
+      return self.__shape_table(output, max_tokens)
+    return self.__shape_text(output, max_tokens)
+
+  def __parse_structured(self, output):
+    text = output.strip()
+    if not text or text[0] not in '[{':
+      return None
+    try:
+      return json.loads(text, strict=False)
+    except ValueError:
+      pass
+    try:
+      #tools such as Retriever return str() of a dict
+      return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+      return None
+
+  def __is_table(self, output):
+    lines = output.strip('\n').split('\n')
+    if len(lines) < 3 or '|' not in lines[0]:
+      return False
+    columns = lines[0].count('|')
+    return sum(1 for l in lines[1:] if l.count('|') == columns) >= (len(lines) - 1) * 0.9
+
+  def __fit(self, build, upper, max_tokens):
+    """Largest n in [0, upper] for which build(n) fits in max_tokens, found by binary search."""
+    low, high = 0, upper
+    while low < high:
+      mid = (low + high + 1) // 2
+      if count_text_tokens(build(mid)) <= max_tokens:
+        low = mid
+      else:
+        high = mid - 1
+    return build(low)
+
+  def __shape_table(self, output, max_tokens):
+    lines = output.strip('\n').split('\n')
+    header, rows = lines[0], lines[1:]
+
+    def build(n):
+      tail = n // self.TAIL_SHARE
+      head = n - tail
+      kept = rows[:head] + [f'[... {len(rows) - n} of {len(rows)} rows omitted ...]'] + (rows[len(rows) - tail:] if tail > 0 else [])
+      return '\n'.join([header] + kept) + '\n'
+
+    return self.__fit(build, len(rows) - 1, max_tokens)
+
+  def __shape_text(self, output, max_tokens):
+    def build(n):
+      tail = n // self.TAIL_SHARE
+      head = n - tail
+      return f'{output[:head]}\n[... {len(output) - n} characters omitted ...]\n{output[len(output) - tail:] if tail > 0 else ""}'
+
+    return self.__fit(build, len(output) - 1, max_tokens)
+
+  def __shape_structured(self, value, max_tokens):
+    def build(n):
+      return json.dumps(self.__project(value, max(1, n // 10), n * 4), default=str)
+
+    #n scales both the list length and the string length kept
+    return self.__fit(build, max_tokens, max_tokens)
+
+  def __project(self, value, max_items, max_chars):
+    if isinstance(value, dict):
+      return {k: self.__project(v, max_items, max_chars) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+      ret = [self.__project(v, max_items, max_chars) for v in value[:max_items]]
+      if len(value) > max_items:
+        ret.append(f'[... {len(value) - max_items} more items omitted ...]')
+      return ret
+    if isinstance(value, str) and len(value) > max_chars:
+      return f'{value[:max_chars]}[... {len(value) - max_chars} characters omitted ...]'
+    return value
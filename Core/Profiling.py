@@ -0,0 +1,142 @@
+import collections
+import json
+import threading
+import time
+import uuid
+
+
+class Span():
+  """Timing and attributes of one unit of work: a run of the agent loop, an LLM call, a tool call or a log flush."""
+
+  def __init__(self, tracer, kind, name, trace_id = None, attributes = {}):
+    self.tracer = tracer
+    self.span_id = uuid.uuid4().hex[:16]
+    self.trace_id = trace_id
+    self.kind = kind
+    self.name = name
+    self.attributes = dict(attributes)
+    self.start_time = None
+    self.start_perf = None
+    self.end_time = None
+    self.error = None
+
+  def set(self, **attributes):
+    self.attributes.update(attributes)
+
+  @property
+  def duration(self):
+    if self.start_time is None or self.end_time is None:
+      return None
+    return self.end_time - self.start_time
+
+  def __enter__(self):
+    self.start_time = time.time()
+    self.start_perf = time.perf_counter()
+    self.tracer.span_started(self)
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self.end_time = self.start_time + (time.perf_counter() - self.start_perf)
+    if exc is not None:
+      self.error = f'{exc_type.__name__}: {exc}'
+    self.tracer.span_ended(self)
+    return False
+
+  def to_dict(self):
+    return {
+      'trace_id': self.trace_id,
+      'span_id': self.span_id,
+      'kind': self.kind,
+      'name': self.name,
+      'start_time': self.start_time,
+      'end_time': self.end_time,
+      'duration': self.duration,
+      'error': self.error,
+      'attributes': self.attributes
+    }
+
+
+class Tracer():
+  """Creates spans and hands them to callbacks. A callback is any object with on_span_start(span) and/or on_span_end(span)."""
+
+  def __init__(self, callbacks = []):
+    self.callbacks = list(callbacks)
+
+  def add_callback(self, callback):
+    if callback not in self.callbacks:
+      self.callbacks.append(callback)
+
+  def remove_callback(self, callback):
+    if callback in self.callbacks:
+      self.callbacks.remove(callback)
+
+  def span(self, kind, name, trace_id = None, **attributes):
+    return Span(self, kind, name, trace_id, attributes)
+
+  def span_started(self, span):
+    for cb in self.callbacks:
+      if hasattr(cb, 'on_span_start'):
+        self.__safe_call(cb.on_span_start, span)
+
+  def span_ended(self, span):
+    for cb in self.callbacks:
+      if hasattr(cb, 'on_span_end'):
+        self.__safe_call(cb.on_span_end, span)
+
+  def __safe_call(self, func, span):
+    #profiling must never break a conversation
+    try:
+      func(span)
+    except Exception as e:
+      print(f'Profiling callback failed: {e}')
+
+
+class InMemoryCollector():
+  """Keeps the last max_spans finished spans."""
+
+  def __init__(self, max_spans = 10000):
+    self.finished = collections.deque(maxlen = max_spans)
+    self.lock = threading.Lock()
+
+  def on_span_end(self, span):
+    with self.lock:
+      self.finished.append(span.to_dict())
+
+  def spans(self, kind = None, trace_id = None):
+    with self.lock:
+      return [s for s in self.finished if (kind is None or s['kind'] == kind) and (trace_id is None or s['trace_id'] == trace_id)]
+
+  def summary(self):
+    """Count, total and max duration per span kind."""
+    ret = {}
+    for s in self.spans():
+      stats = ret.setdefault(s['kind'], {'count': 0, 'errors': 0, 'total_duration': 0.0, 'max_duration': 0.0})
+      stats['count'] += 1
+      stats['errors'] += 1 if s['error'] else 0
+      stats['total_duration'] += s['duration'] or 0.0
+      stats['max_duration'] = max(stats['max_duration'], s['duration'] or 0.0)
+    return ret
+
+  def to_json(self):
+    return json.dumps(self.spans(), default=str)
+
+  def clear(self):
+    with self.lock:
+      self.finished.clear()
+
+
+class JsonExporter():
+  """Writes every finished span as a line of JSON to a file path or an open stream."""
+
+  def __init__(self, target):
+    self.lock = threading.Lock()
+    self.stream = open(target, 'a') if isinstance(target, str) else target
+
+  def on_span_end(self, span):
+    line = json.dumps(span.to_dict(), default=str)
+    with self.lock:
+      self.stream.write(line + '\n')
+      self.stream.flush()
+
+  def close(self):
+    self.stream.close()
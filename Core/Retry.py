@@ -0,0 +1,162 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+from Core.Router import is_retriable
+
+
+def retry_after(e):
+  """Seconds the server asked us to wait in the Retry-After (or retry-after-ms) header of the error's response, if any."""
+  response = getattr(e, 'response', None)
+  headers = getattr(response, 'headers', None) or getattr(e, 'headers', None)
+  if not headers:
+    return None
+  try:
+    if headers.get('retry-after-ms', None) is not None:
+      return float(headers['retry-after-ms']) / 1000
+    value = headers.get('retry-after', None) or headers.get('Retry-After', None)
+    if value is None:
+      return None
+    if value.strip().replace('.', '', 1).isdigit():
+      return float(value)
+    #an HTTP date
+    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (ValueError, TypeError, AttributeError):
+    return None
+
+
+class TokenBucket():
+  """Allows rate requests per second on average with bursts of up to capacity. Shared by every thread of the process."""
+
+  def __init__(self, rate, capacity = None):
+    self.rate = rate
+    self.capacity = capacity if capacity is not None else max(1.0, rate)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def __take(self, tokens):
+    """Takes tokens if available and returns 0, otherwise returns how long to wait before trying again."""
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      if self.tokens >= tokens:
+        self.tokens -= tokens
+        return 0.0
+      return (tokens - self.tokens) / self.rate
+
+  def acquire(self, tokens = 1):
+    """Blocks until tokens are available. Returns the time spent waiting."""
+    waited = 0.0
+    wait = self.__take(tokens)
+    while wait > 0:
+      time.sleep(wait)
+      waited += wait
+      wait = self.__take(tokens)
+    return waited
+
+  async def aacquire(self, tokens = 1):
+    waited = 0.0
+    wait = self.__take(tokens)
+    while wait > 0:
+      await asyncio.sleep(wait)
+      waited += wait
+      wait = self.__take(tokens)
+    return waited
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(key, requests_per_minute):
+  """The process-wide TokenBucket for an LLM provider. Every ChatBot calling the same provider shares it."""
+  with _limiters_lock:
+    if key not in _limiters:
+      _limiters[key] = TokenBucket(requests_per_minute / 60)
+    return _limiters[key]
+
+
+class RetryingClient():
+  """Wraps an LLM client so that rate limits, timeouts and 5xx errors are retried with exponential backoff and jitter.
+
+  A Retry-After header on the error takes precedence over the backoff. When a limiter is given, each call first waits
+  for a token so the process stays under the provider's quota. Streams are only retried before the first chunk."""
+
+  def __init__(self, client, max_retries = 3, base_delay = 1.0, max_delay = 30.0, limiter = None):
+    self.client = client
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.limiter = limiter
+    self.retries = 0
+
+  def delay(self, attempt, e):
+    """Seconds to wait before retry number attempt (starting at 0)."""
+    server_delay = retry_after(e)
+    if server_delay is not None:
+      return min(server_delay, self.max_delay)
+    #full jitter: a random wait up to the exponential backoff, so replicas don't retry in lockstep
+    return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+  def __should_retry(self, attempt, e):
+    if attempt >= self.max_retries or not is_retriable(e):
+      return False
+    self.retries += 1
+    return True
+
+  def predict_messages(self, messages, tools = None):
+    attempt = 0
+    while True:
+      if self.limiter is not None:
+        self.limiter.acquire()
+      try:
+        return self.client.predict_messages(messages, tools = tools)
+      except Exception as e:
+        if not self.__should_retry(attempt, e):
+          raise
+        delay = self.delay(attempt, e)
+        print(f'LLM call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s...')
+        time.sleep(delay)
+        attempt += 1
+
+  async def apredict_messages(self, messages, tools = None):
+    attempt = 0
+    while True:
+      if self.limiter is not None:
+        await self.limiter.aacquire()
+      try:
+        return await self.client.apredict_messages(messages, tools = tools)
+      except Exception as e:
+        if not self.__should_retry(attempt, e):
+          raise
+        delay = self.delay(attempt, e)
+        print(f'LLM call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s...')
+        await asyncio.sleep(delay)
+        attempt += 1
+
+  def stream_messages(self, messages, tools = None):
+    attempt = 0
+    while True:
+      if self.limiter is not None:
+        self.limiter.acquire()
+      try:
+        if hasattr(self.client, 'stream_messages'):
+          chunks = iter(self.client.stream_messages(messages, tools = tools))
+        else:
+          chunks = iter(self.client.stream(messages, tools = tools))
+        first = next(chunks, None)
+        break
+      except Exception as e:
+        if not self.__should_retry(attempt, e):
+          raise
+        delay = self.delay(attempt, e)
+        print(f'LLM call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s...')
+        time.sleep(delay)
+        attempt += 1
+
+    if first is not None:
+      yield first
+    yield from chunks
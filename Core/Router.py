@@ -0,0 +1,331 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import random
+import threading
+import time
+
+
+def error_status(e):
+  """The HTTP status code carried by an LLM client exception, if any."""
+  for obj in (e, getattr(e, 'response', None)):
+    code = getattr(obj, 'status_code', None)
+    if isinstance(code, int):
+      return code
+  return None
+
+
+def is_retriable(e):
+  """Timeouts, rate limits (429) and server errors (5xx) are worth sending to another provider. Errors are recognized by
+  type and status code only, the message of other errors (such as invalid LLM output) may mention anything."""
+  if isinstance(e, (TimeoutError, concurrent.futures.TimeoutError, asyncio.TimeoutError)):
+    return True
+  name = type(e).__name__.lower()
+  if 'timeout' in name or 'connection' in name or 'ratelimit' in name:
+    return True
+  status = error_status(e)
+  return status is not None and (status == 429 or status >= 500)
+
+
+class Provider():
+  """An LLM client plus the rolling latency and error statistics the router uses to rank it. model is the model the
+  client calls, used to price its responses. It defaults to name."""
+
+  def __init__(self, name, client, weight = 1, window = 100, model = None):
+    self.name = name
+    self.model = model if model is not None else name
+    self.client = client
+    self.weight = weight
+    self.latencies = collections.deque(maxlen = window)
+    self.outcomes = collections.deque(maxlen = window)
+    self.calls = 0
+    self.errors = 0
+    self.lock = threading.Lock()
+
+  def record(self, latency, ok):
+    with self.lock:
+      self.calls += 1
+      self.outcomes.append(ok)
+      if ok:
+        self.latencies.append(latency)
+      else:
+        self.errors += 1
+
+  def error_rate(self):
+    with self.lock:
+      if len(self.outcomes) == 0:
+        return 0.0
+      return 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+  def latency(self, percentile = 0.5):
+    with self.lock:
+      if len(self.latencies) == 0:
+        return None
+      ordered = sorted(self.latencies)
+      return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+
+class _Attempt():
+  """A call to a provider on the router's pool. picked_up resolves to the time a worker started on it."""
+
+  def __init__(self, provider):
+    self.provider = provider
+    self.picked_up = concurrent.futures.Future()
+    self.abandoned = False
+
+
+class LLMRouter():
+  """Sends each LLM call to one of several providers, failing over on timeouts, 429s and 5xx errors.
+
+  strategy picks the order providers are tried in: 'ordered' keeps the configured order, 'weighted' picks the first
+  provider at random by weight, and 'latency' prefers the lowest rolling median latency. Providers whose recent error
+  rate is above max_error_rate are tried last. With hedge_after set, a call that hasn't answered after that many
+  seconds is also sent to the next provider and the first answer wins. The chosen provider, failovers and hedges are
+  added to the response's response_metadata and counted in stats().
+
+  With timeout or hedge_after set, sync calls run on a pool of max_workers threads shared by every conversation, so it
+  is sized for concurrent serving. timeout and hedge_after count from when a worker starts on the call, and time spent
+  waiting for a worker is never charged to a provider."""
+
+  def __init__(self, providers, strategy = 'ordered', timeout = None, hedge_after = None, max_error_rate = 0.5, max_workers = 64):
+    if len(providers) == 0:
+      raise ValueError('LLMRouter needs at least one provider.')
+    self.providers = providers
+    self.strategy = strategy
+    self.timeout = timeout
+    self.hedge_after = hedge_after
+    self.max_error_rate = max_error_rate
+    self.counters = collections.Counter()
+    self.lock = threading.Lock()
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'llm-router')
+
+  def order(self):
+    """Providers in the order they should be tried for the next call."""
+    providers = list(self.providers)
+    if self.strategy == 'weighted':
+      first = random.choices(providers, weights = [p.weight for p in providers])[0]
+      providers.remove(first)
+      providers.insert(0, first)
+    elif self.strategy == 'latency':
+      providers.sort(key = lambda p: p.latency() if p.latency() is not None else 0.0)
+    #sorted is stable, so healthy providers keep their relative order
+    return sorted(providers, key = lambda p: p.error_rate() > self.max_error_rate)
+
+  def stats(self):
+    with self.lock:
+      counters = dict(self.counters)
+    return {
+      'counters': counters,
+      'providers': {p.name: {'calls': p.calls, 'errors': p.errors, 'error_rate': p.error_rate(),
+                             'p50_latency': p.latency(0.5), 'p95_latency': p.latency(0.95)} for p in self.providers}
+    }
+
+  def __count(self, name):
+    with self.lock:
+      self.counters[name] += 1
+
+  def __tag(self, response, provider, failovers, hedged):
+    response.response_metadata['provider'] = provider.name
+    response.response_metadata['provider_model'] = provider.model
+    response.response_metadata['failovers'] = failovers
+    response.response_metadata['hedged'] = hedged
+    self.__count(f'routed:{provider.name}')
+    return response
+
+  def __call(self, provider, messages, tools, attempt = None):
+    if attempt is not None:
+      attempt.picked_up.set_result(time.monotonic())
+    start = time.perf_counter()
+    try:
+      response = provider.client.predict_messages(messages, tools = tools)
+    except Exception:
+      if attempt is None or not attempt.abandoned:
+        provider.record(time.perf_counter() - start, False)
+      raise
+    #an attempt given up on was already charged with the timeout
+    if attempt is None or not attempt.abandoned:
+      provider.record(time.perf_counter() - start, True)
+    return response
+
+  def predict_messages(self, messages, tools = None):
+    providers = self.order()
+    failovers = 0
+    last_error = None
+    i = 0
+    while i < len(providers):
+      provider = providers[i]
+      hedge = providers[i + 1] if self.hedge_after is not None and i + 1 < len(providers) else None
+      started = []
+      try:
+        if hedge is None and self.timeout is None:
+          return self.__tag(self.__call(provider, messages, tools), provider, failovers, False)
+        winner, response, hedged = self.__call_with_hedge(provider, hedge, messages, tools, started)
+        return self.__tag(response, winner, failovers, hedged)
+      except Exception as e:
+        if not is_retriable(e):
+          raise
+        last_error = e
+        failovers += 1
+        self.__count('failovers')
+        print(f'LLM provider {provider.name} failed ({type(e).__name__}: {e}), failing over...')
+        #the hedge provider is only skipped if it was actually tried
+        i += 2 if hedge in started else 1
+    raise last_error
+
+  def __call_with_hedge(self, provider, hedge, messages, tools, started):
+    """Calls provider, and also hedge if provider is slower than hedge_after. Returns (provider, response, hedged).
+    Every provider called is appended to started."""
+    attempts = {}
+    first = self.__submit(attempts, provider, messages, tools)
+    started.append(provider)
+    hedged = False
+    errors = []
+    while len(attempts) > 0:
+      #wake up when a call finishes, when a worker starts on a call, or when a timeout or the hedge is due
+      waiting = list(attempts.keys()) + [a.picked_up for a in attempts.values() if not a.picked_up.done()]
+      due = [a.picked_up.result() + self.timeout for a in attempts.values() if a.picked_up.done()] if self.timeout is not None else []
+      if hedge is not None and not hedged and first.picked_up.done():
+        due.append(first.picked_up.result() + self.hedge_after)
+      wait_for = max(0.0, min(due) - time.monotonic()) if len(due) > 0 else None
+      done, pending = concurrent.futures.wait(waiting, timeout = wait_for, return_when = concurrent.futures.FIRST_COMPLETED)
+
+      for future in [f for f in done if f in attempts]:
+        winner = attempts.pop(future).provider
+        try:
+          response = future.result()
+        except Exception as e:
+          errors.append(e)
+          continue
+        if hedged:
+          self.__count('hedge_wins' if winner is hedge else 'hedge_losses')
+        return winner, response, hedged
+
+      now = time.monotonic()
+      if self.timeout is not None:
+        for future, attempt in list(attempts.items()):
+          if attempt.picked_up.done() and now - attempt.picked_up.result() >= self.timeout:
+            del attempts[future]
+            attempt.abandoned = True
+            attempt.provider.record(self.timeout, False)
+            errors.append(TimeoutError(f'LLM provider {attempt.provider.name} did not answer within {self.timeout}s.'))
+      if hedge is not None and not hedged and first.picked_up.done() and now - first.picked_up.result() >= self.hedge_after:
+        hedged = True
+        self.__count('hedges')
+        self.__submit(attempts, hedge, messages, tools)
+        started.append(hedge)
+    raise errors[-1]
+
+  def __submit(self, attempts, provider, messages, tools):
+    attempt = _Attempt(provider)
+    #calls run in a copy of the caller's context, so context variables such as the conversation scope still apply
+    attempts[self.executor.submit(contextvars.copy_context().run, self.__call, provider, messages, tools, attempt)] = attempt
+    return attempt
+
+  async def __acall(self, provider, messages, tools):
+    start = time.perf_counter()
+    try:
+      response = await provider.client.apredict_messages(messages, tools = tools)
+    except Exception:
+      provider.record(time.perf_counter() - start, False)
+      raise
+    provider.record(time.perf_counter() - start, True)
+    return response
+
+  async def apredict_messages(self, messages, tools = None):
+    providers = self.order()
+    failovers = 0
+    last_error = None
+    i = 0
+    while i < len(providers):
+      provider = providers[i]
+      hedge = providers[i + 1] if self.hedge_after is not None and i + 1 < len(providers) else None
+      started = []
+      try:
+        winner, response, hedged = await self.__acall_with_hedge(provider, hedge, messages, tools, started)
+        return self.__tag(response, winner, failovers, hedged)
+      except Exception as e:
+        if not is_retriable(e):
+          raise
+        last_error = e
+        failovers += 1
+        self.__count('failovers')
+        print(f'LLM provider {provider.name} failed ({type(e).__name__}: {e}), failing over...')
+        i += 2 if hedge in started else 1
+    raise last_error
+
+  async def __acall_with_hedge(self, provider, hedge, messages, tools, started):
+    #a cancelled __acall records nothing, so timed out calls are charged here and hedge losers aren't charged at all
+    start = time.monotonic()
+    tasks = {asyncio.ensure_future(self.__acall(provider, messages, tools)): (provider, start)}
+    started.append(provider)
+    hedged = False
+    errors = []
+    try:
+      while len(tasks) > 0:
+        due = [called + self.timeout for p, called in tasks.values()] if self.timeout is not None else []
+        if hedge is not None and not hedged:
+          due.append(start + self.hedge_after)
+        wait_for = max(0.0, min(due) - time.monotonic()) if len(due) > 0 else None
+        done, pending = await asyncio.wait(tasks.keys(), timeout = wait_for, return_when = asyncio.FIRST_COMPLETED)
+        for task in done:
+          winner = tasks.pop(task)[0]
+          try:
+            response = task.result()
+          except Exception as e:
+            errors.append(e)
+            continue
+          if hedged:
+            self.__count('hedge_wins' if winner is hedge else 'hedge_losses')
+          return winner, response, hedged
+
+        now = time.monotonic()
+        if self.timeout is not None:
+          for task, (p, called) in list(tasks.items()):
+            if now - called >= self.timeout:
+              del tasks[task]
+              task.cancel()
+              p.record(self.timeout, False)
+              errors.append(TimeoutError(f'LLM provider {p.name} did not answer within {self.timeout}s.'))
+        if hedge is not None and not hedged and now - start >= self.hedge_after:
+          hedged = True
+          self.__count('hedges')
+          tasks[asyncio.ensure_future(self.__acall(hedge, messages, tools))] = (hedge, now)
+          started.append(hedge)
+      raise errors[-1]
+    finally:
+      for task in tasks.keys():
+        task.cancel()
+
+  def stream_messages(self, messages, tools = None):
+    """Streams from the first provider that starts answering. Failover only happens before the first chunk arrives."""
+    providers = self.order()
+    failovers = 0
+    last_error = None
+    for provider in providers:
+      start = time.perf_counter()
+      try:
+        if hasattr(provider.client, 'stream_messages'):
+          chunks = iter(provider.client.stream_messages(messages, tools = tools))
+        else:
+          chunks = iter(provider.client.stream(messages, tools = tools))
+        first = next(chunks, None)
+      except Exception as e:
+        provider.record(time.perf_counter() - start, False)
+        if not is_retriable(e):
+          raise
+        last_error = e
+        failovers += 1
+        self.__count('failovers')
+        print(f'LLM provider {provider.name} failed ({type(e).__name__}: {e}), failing over...')
+        continue
+
+      provider.record(time.perf_counter() - start, True)
+      if first is not None:
+        #the tags on the first chunk carry over to the assembled message
+        yield self.__tag(first, provider, failovers, False)
+      else:
+        self.__count(f'routed:{provider.name}')
+      yield from chunks
+      return
+    raise last_error
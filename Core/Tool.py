@@ -8,17 +8,36 @@ import inspect
 import os
 import openai
 import json
-import uuid
-import datetime
+import time
+import asyncio
+import functools
+import concurrent.futures
 #from FunctionDefiner import ChatFunctionBase
-from langchain_openai import ChatOpenAI
-from Core.ChatConverter import ChatDatabricks_ToolConverter
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from Core.ChatConverter import ChatDatabricks_ToolConverter, ChatDatabricks_NativeTools, NATIVE_TOOL_ENDPOINTS, tool_parser
+from Core.Budget import RunBudget
+from Core.ClientPool import client_pool
+from Core.Router import LLMRouter, Provider
+from Core.Retry import RetryingClient, get_rate_limiter
+from Core.Context import ContextWindow, ContextOverflow, count_text_tokens
+from Core.OutputShaper import OutputShaper
+from Core.ToolCache import tool_cache
+from Core.ToolRegistry import tool_registry
+from Core.ToolGuard import ToolCall, ToolCancelled, ToolTimeout, run_cancellable, backend_key, get_breaker
+from Core.Concurrency import QueueTimeout, get_backend_limiter
+from Core.Messages import Conversation, normalize, conversation_scope
+from Core.Profiling import Tracer
+from Core.Budget import token_usage
+from Core.Usage import PriceTable
+from Core.ConversationLog import ConversationLogger, SparkTableSink, LocalFileSink, get_logger, log_row, spark_available
 from langchain_core.messages import HumanMessage, AIMessage, ChatMessage, SystemMessage, ToolMessage
 #from langchain.tools import format_tool_to_openai_function, YouTubeSearchTool, MoveFileTool
 
 class ChatBot():
 
     __OPENAI_KEY = os.getenv("OPENAI_API_KEY")
+    __FINAL_ANSWER_PROMPT = "You have used up your budget for tool calls. Do not call any more tools. Respond to the user now with your best answer using the information gathered so far."
+    __BUDGET_EXHAUSTED_MESSAGE = "I wasn't able to finish this request within the allotted time. Please try again or narrow down the question."
     '''
     __BASE_TOOLS = [
             {
@@ -46,28 +65,84 @@ class ChatBot():
         model = config.get('model', "gpt-4-turbo-preview")
         output_table = config.get('output_table', "")
         provider = config.get('provider', 'databricks')
-        endpoint_type = config.get('endpoint-type', 'chat') #chat-basic, completions, embeddings
+        endpoint_type = config.get('endpoint_type', config.get('endpoint-type', 'chat')) #chat-basic, completions, embeddings
+        #True sends tools natively to chat-basic endpoints, False always uses the text tool protocol, None decides by endpoint
+        self.native_tools = config.get('native_tools', None)
 
-        if model == '3.5':
-            model = "gpt-3.5-turbo"
-        elif model == '4':
-            model = "gpt-4-turbo-preview"
-        elif model == 'mixtral':
-            model = 'databricks-mixtral-8x7b-instruct'
-            endpoint_type = 'chat-basic' 
-        elif model == 'llama2':
-            model = 'databricks-llama-2-70b-chat'
-            endpoint_type = 'chat-basic' 
-        elif model == 'dbrx' or model == 'databricks-dbrx-instruct':
-            model = 'databricks-dbrx-instruct'
-            endpoint_type = 'chat-basic' 
+        model, endpoint_type = self.__resolve_model(model, endpoint_type)
         self.INSTRUCTION_PROMPT = instruction_prompt
         self.model = model
         self.functions = []#self.__BASE_FUNCTION.copy()
         self.output_table = output_table
         self.endpoint_type = endpoint_type
+
+        #budgets for a single run of the agent loop. None disables the budget.
+        self.max_tool_rounds = config.get('max_tool_rounds', 10)
+        self.max_tokens = config.get('max_tokens', None)
+        self.request_timeout = config.get('request_timeout', None)
+        self.budget_exhausted_message = config.get('budget_exhausted_message', self.__BUDGET_EXHAUSTED_MESSAGE)
+
+        #seconds a tool call may run before it is given up on. None waits for it.
+        self.tool_timeout = config.get('tool_timeout', None)
+        #function name to timeout in seconds, on top of the @tool_timeout tool methods
+        self.tool_timeouts = config.get('tool_timeouts', {})
+        #failure_threshold and reset_timeout of the circuit breaker kept for each tool backend
+        self.circuit_breaker = config.get('circuit_breaker', {})
+        #process-wide cap on calls in flight to each tool backend. backend_limits is keyed by backend (for example
+        #sql-warehouse:<id>) or backend kind (sql-warehouse), max_backend_calls applies to the rest. None is unlimited.
+        self.max_backend_calls = config.get('max_backend_calls', None)
+        self.backend_limits = config.get('backend_limits', {})
+        #tool calls run concurrently on a pool shared by every conversation the bot serves, so max_tool_workers caps the
+        #tool calls in flight across all of them and is sized for concurrent serving. Tool timeouts count from when a
+        #worker starts on the call, so time spent waiting for a worker doesn't use them up.
+        self.tool_executor = concurrent.futures.ThreadPoolExecutor(max_workers = config.get('max_tool_workers', 32), thread_name_prefix = 'tool')
+
+        #limits what part of the thread is sent to the LLM. Disabled unless one of the limits is configured.
+        context_keys = ['context_keep_turns', 'max_context_tokens', 'context_keep_tool_turns']
+        self.context_window = None
+        if any(config.get(k, None) is not None for k in context_keys):
+            self.context_window = ContextWindow(keep_turns = config.get('context_keep_turns', None), 
+                                                max_tokens = config.get('max_context_tokens', None), 
+                                                keep_tool_turns = config.get('context_keep_tool_turns', None),
+                                                summary_tokens = config.get('context_summary_tokens', 500))
+
+        #keeps large tool outputs within a token budget. Any object with a shape(tool_name, output) method can be supplied.
+        self.output_shaper = config.get('output_shaper', None)
+        if self.output_shaper is None:
+            self.output_shaper = OutputShaper(config.get('tool_output_max_tokens', None), config.get('tool_output_limits', {}))
+
+        #with many tools, only the ones relevant to the latest user message are sent. See Core/ToolSelector.py
+        self.tool_selector = self.__create_tool_selector(config)
+
+        #function name to ttl in seconds for tool results served from the process-wide cache, on top of the @cacheable tool methods
+        self.tool_cache_ttls = config.get('tool_cache_ttls', {})
+
+        #model name to USD per million prompt and completion tokens, on top of the defaults in Core/Usage.py
+        self.price_table = PriceTable(config.get('prices', {}))
+
+        #conversations are written in batches from a background thread, to the output table when spark is available, 
+        #otherwise to rotating files in log_directory. Any LogSink can be supplied with log_sink.
+        self.logger = self.__create_logger(config)
+
+        #spans for every run, LLM call, tool call and log flush are passed to these callbacks. See Core/Profiling.py
+        self.tracer = Tracer()
+        for cb in config.get('profiling_callbacks', []):
+            self.add_callback(cb)
         
+        #max_retries, base_delay and max_delay for LLM calls that hit a rate limit, a timeout or a 5xx error
+        self.llm_retry = config.get('llm_retry', {})
+
+        #set when a model is called with the text tool protocol, whose tool prompt is larger than the tool specs
+        self.text_tool_protocol = False
+        #with providers set, LLM calls are routed across several models with failover and optional hedging. See Core/Router.py
+        self.router = self.__create_router(config)
+        if self.router is not None:
+            #retried once around the router, so a failing provider is failed over right away instead of being retried first
+            self.llm = self.__retrying(self.router)
+        else:
+            self.llm = self.__llm_client(self.model, self.endpoint_type, config.get('llm_requests_per_minute', None))
         self.helpers = []
+        self.dispatch = {}
         for h in helpers:
             self.__add_helper(h)
         
@@ -75,25 +150,149 @@ class ChatBot():
 
         self.__initialize()
 
+    def __create_tool_selector(self, config):
+        #any object with a select(functions, query) method can be supplied with tool_selector
+        if config.get('tool_selector', None) is not None:
+            return config['tool_selector']
+        selection = config.get('tool_selection', None)
+        if not selection:
+            return None
+        if selection is True:
+            #enabled with the defaults
+            selection = {}
+        if not isinstance(selection, dict):
+            raise ValueError(f'tool_selection must be True or a dict of options (embedding_model, top_k, pinned), got {selection!r}')
+
+        from Core.ToolSelector import ToolSelector
+        model = selection.get('embedding_model', 'text-embedding-3-small')
+        if model.startswith('databricks-'):
+            from langchain_community.embeddings import DatabricksEmbeddings
+            embeddings = client_pool.get(('databricks-embeddings', model), lambda: DatabricksEmbeddings(endpoint = model))
+        else:
+            embeddings = client_pool.get(('openai-embeddings', model), lambda: OpenAIEmbeddings(model = model, openai_api_key=self.__OPENAI_KEY))
+        return ToolSelector(embeddings, top_k = selection.get('top_k', 8), pinned = selection.get('pinned', []))
+
+    def __create_logger(self, config):
+        sink = config.get('log_sink', None)
+        log_directory = config.get('log_directory', '')
+        if sink is not None:
+            sink_key, create_sink = ('custom', id(sink)), lambda: sink
+        elif self.output_table and spark_available():
+            sink_key, create_sink = ('spark', self.output_table), lambda: SparkTableSink(self.output_table)
+        elif log_directory:
+            sink_key, create_sink = ('local', log_directory), lambda: LocalFileSink(log_directory, 
+                                                                                   file_format = config.get('log_format', 'jsonl'), 
+                                                                                   compression = config.get('log_compression', 'gzip'), 
+                                                                                   max_file_rows = config.get('log_max_file_rows', 100000))
+        else:
+            return None
+
+        return get_logger(sink_key, lambda: ConversationLogger(create_sink(), 
+                                                               batch_size = config.get('log_batch_size', 500), 
+                                                               flush_interval = config.get('log_flush_interval', 30)))
+
+    def add_callback(self, callback):
+        """Registers a profiling callback (an object with on_span_start and/or on_span_end) such as InMemoryCollector."""
+        self.tracer.add_callback(callback)
+        if self.logger is not None:
+            self.logger.tracer.add_callback(callback)
+
     def __add_helper(self, helper):
         ind = len(self.helpers)
         if helper != None:
             self.helpers.append(helper)
-            for f in self.function_definitions(helper, f'helper_{ind}--'):
-              self.functions.append(f)
+            definitions, dispatch = tool_registry.register(helper, f'helper_{ind}--')
+            self.functions.extend(definitions)
+            self.dispatch.update(dispatch)
         #print(self.functions)
 
     def __initialize(self):
-        self.messages = []
-        self.conversation = []
-        self.conversation_id = str(uuid.uuid4())
-        if self.INSTRUCTION_PROMPT != "":
-            self.__add_message(SystemMessage(content=self.INSTRUCTION_PROMPT))
+        #the conversation used by prompt, reset and the conversation_id/messages/output_thread accessors
+        self.conversation = self.start_conversation()
+
+    def __resolve_model(self, model, endpoint_type):
+        if model == '3.5':
+            model = "gpt-3.5-turbo"
+        elif model == '4':
+            model = "gpt-4-turbo-preview"
+        elif model == 'mixtral':
+            model = 'databricks-mixtral-8x7b-instruct'
+            endpoint_type = 'chat-basic' 
+        elif model == 'llama2':
+            model = 'databricks-llama-2-70b-chat'
+            endpoint_type = 'chat-basic' 
+        elif model == 'dbrx' or model == 'databricks-dbrx-instruct':
+            model = 'databricks-dbrx-instruct'
+            endpoint_type = 'chat-basic' 
+        return model, endpoint_type
+
+    def __llm_client(self, model, endpoint_type, requests_per_minute = None, retry = True):
         #TODO: set this up to handle open ai, azureopenai and external models on databricks.
-        if self.endpoint_type == 'chat-basic':
-            self.llm = ChatDatabricks_ToolConverter(target_uri="databricks", endpoint=self.model, temperature=0.2)
+        #clients are shared across conversations so their connection pools survive between requests
+        if endpoint_type == 'chat-basic':
+            #native tool endpoints fall back to the text tool protocol
+            self.text_tool_protocol = True
+
+        if endpoint_type == 'chat-basic' and self.__native_tools(model):
+            key = ('databricks-native', model, 0.2)
+            fallback = self.__tool_converter(model)
+            client = client_pool.get(key, lambda: ChatDatabricks_NativeTools(self.__databricks_openai_client(model), fallback))
+        elif endpoint_type == 'chat-basic':
+            key = ('databricks', model, 0.2)
+            client = self.__tool_converter(model)
         else:
-            self.llm = ChatOpenAI(model = self.model, openai_api_key=self.__OPENAI_KEY)
+            key = ('openai', model)
+            #stream_usage makes streamed completions report their token usage in the last chunk
+            client = client_pool.get(key, lambda: ChatOpenAI(model = model, openai_api_key=self.__OPENAI_KEY, stream_usage = True))
+
+        limiter = get_rate_limiter(key, requests_per_minute) if requests_per_minute else None
+        if not retry:
+            return RetryingClient(client, max_retries = 0, limiter = limiter) if limiter is not None else client
+        return self.__retrying(client, limiter)
+
+    def __retrying(self, client, limiter = None):
+        #rate limits and transient errors are retried here instead of failing the whole conversation
+        return RetryingClient(client, 
+                              max_retries = self.llm_retry.get('max_retries', 3), 
+                              base_delay = self.llm_retry.get('base_delay', 1.0), 
+                              max_delay = self.llm_retry.get('max_delay', 30.0), 
+                              limiter = limiter)
+
+    def __tool_converter(self, model):
+        return client_pool.get(('databricks', model, 0.2), lambda: ChatDatabricks_ToolConverter(target_uri="databricks", endpoint=model, temperature=0.2))
+
+    def __native_tools(self, model):
+        if os.getenv('DATABRICKS_HOST', '') == '':
+            #the openai compatible API is reached through the workspace url
+            return False
+        if self.native_tools is None:
+            return model.startswith(NATIVE_TOOL_ENDPOINTS)
+        return self.native_tools
+
+    def __databricks_openai_client(self, model):
+        #serving endpoints speak the openai chat completions API, tools and tool messages included
+        host = os.getenv('DATABRICKS_HOST', '').rstrip('/')
+        if not host.startswith('http'):
+            host = f'https://{host}'
+        return ChatOpenAI(model = model, base_url = f'{host}/serving-endpoints', openai_api_key = os.getenv('DATABRICKS_TOKEN'), temperature = 0.2)
+
+    def __create_router(self, config):
+        #each provider is a model name or a dict with model, endpoint-type, weight, name and requests_per_minute
+        providers = config.get('providers', [])
+        if len(providers) == 0:
+            return None
+
+        routed = []
+        for p in providers:
+            p = p if isinstance(p, dict) else {'model': p}
+            model, endpoint_type = self.__resolve_model(p['model'], p.get('endpoint-type', self.endpoint_type))
+            client = self.__llm_client(model, endpoint_type, p.get('requests_per_minute', None), retry = False)
+            routed.append(Provider(p.get('name', model), client, weight = p.get('weight', 1), model = model))
+        return LLMRouter(routed, 
+                         strategy = config.get('routing_strategy', 'ordered'), 
+                         timeout = config.get('llm_timeout', None), 
+                         hedge_after = config.get('hedge_after', None),
+                         max_workers = config.get('max_llm_workers', 64))
 
     def __str__(self):
         ret = ""
@@ -101,91 +300,72 @@ class ChatBot():
             ret += f"{msg.type}:\t{msg.content}"
         return ret
 
-    def __add_message(self, message):
-      self.messages.append(message)
-      self.conversation.append({'conversation_id': self.conversation_id, 
-                        'ordinal_position': len(self.messages),
-                        'raw_message': message,
-                        'output_message': self.__translate_message(message),
-                        'created_date': datetime.datetime.now(),
-                        'logged': False})
-
-    def __log_conversation(self):
-      if self.output_table and spark is not None:
-        df = spark.createDataFrame(self.conversation).where('logged == False').drop('logged')
-        df.write.mode('append').saveAsTable(self.output_table)
-        for m in self.conversation:
-          m['logged'] = True
+    @property
+    def conversation_id(self):
+        return self.conversation.conversation_id
 
-    def run_thread(self, messages):
-        self.__initialize()
+    @property
+    def messages(self):
+        """The current conversation as langchain messages."""
+        return self.conversation.messages
+
+    def start_conversation(self, messages = []):
+        """Creates the state for a new conversation from the system prompt and a thread of client messages.
+
+        The ChatBot itself only holds shared, read-only state (helpers, tool definitions, llm client), so conversations
+        started here can be run from many threads or tasks at once."""
+        conversation = Conversation()
+        if self.INSTRUCTION_PROMPT != "":
+            conversation.add(SystemMessage(content=self.INSTRUCTION_PROMPT))
         for msg in messages:
-            self.__parse_msg(msg)
-        return self.__submit_conversation()
-
-    def __parse_msg(self, msg):
-        tp = msg.get('type', 'user')
-        role = msg.get('role', tp)
-
-        if role == 'human' or role == 'user':
-            self.__add_message(HumanMessage(content=msg.get('content', '')))
-        elif role == 'ai' or role == 'assistant':
-            tools = msg.get('tool_calls', [])
-            tool_calls = { 'tool_calls' : tools } if len(tools) > 0 else {}
-            kwargs = msg.get('additional_kwargs', tool_calls)
-            self.__add_message(AIMessage(content = msg.get('content', ''), 
-                                       additional_kwargs = kwargs
-                                       )
-                             )
-        elif role == 'tool':
-            self.__add_message(ToolMessage(content = msg.get('content', ''), 
-                                         name = msg.get('name', ''), 
-                                         tool_call_id = msg.get('tool_call_id', '')
-                                         )
-                             )
+            openai_msg = normalize(msg)
+            if openai_msg is not None:
+                conversation.add_openai(openai_msg)
+        return conversation
+
+    def __log_conversation(self, conversation):
+      if self.logger is not None:
+        rows = [log_row(conversation.conversation_id, r.ordinal_position, r.openai, r.created_date, r.usage) for r in conversation.records if not r.logged]
+        self.logger.log(rows)
+        for r in conversation.records:
+          r.logged = True
+
+    def run_thread(self, messages):
+        self.conversation = self.start_conversation(messages)
+        return self.__submit_conversation(self.conversation)
+
+    def run_conversation(self, conversation):
+        """Runs the agent loop on a conversation from start_conversation and returns the answer. Safe to call concurrently."""
+        return self.__submit_conversation(conversation)
+
+    async def arun_thread(self, messages):
+        """Async version of run_thread. LLM calls use the async client and tool calls are awaited."""
+        self.conversation = self.start_conversation(messages)
+        return await self.__asubmit_conversation(self.conversation)
+
+    async def arun_conversation(self, conversation):
+        """Async version of run_conversation."""
+        return await self.__asubmit_conversation(conversation)
+
+    def stream_thread(self, messages):
+        """Generator version of run_thread. Yields tool call progress events and the tokens of the final answer as they arrive.
+
+        Events are dicts with a type of 'token', 'tool_call', 'tool_result' or 'done'. The 'done' event holds the full answer."""
+        self.conversation = self.start_conversation(messages)
+        yield from self.__stream_conversation(self.conversation)
+
+    def stream_conversation(self, conversation):
+        """Generator version of run_conversation. See stream_thread for the events."""
+        yield from self.__stream_conversation(conversation)
             
     def output_thread(self):
-        return [self.__translate_message(msg) for msg in self.messages]
-    
-    def __translate_message(self, msg):
-        if msg.type == 'system':
-            #system
-            return {
-                'role': 'system',
-                'content': msg.content
-            }
-        elif msg.type == 'human':
-            #user
-            return {
-                'role': 'user',
-                'content': msg.content
-            }
-        elif msg.type == 'ai':
-            #assistant
-            ret = {
-                'role': 'assistant',
-                'content': msg.content
-            }
-            tools = msg.additional_kwargs.get('tool_calls', None)
-            if tools:
-                ret['tool_calls'] = tools
-            return ret
-        elif msg.type == 'tool':
-            #tool
-            return {
-                "role": "tool",
-                "tool_call_id": msg.tool_call_id,
-                "name": msg.name,
-                "content": msg.content
-            }
-
-        return {}
+        return self.conversation.output_thread()
 
 
     def prompt(self, prompt):
         """Continue a conversation"""
-        self.__add_message(HumanMessage(content=prompt))
-        return self.__submit_conversation()
+        self.conversation.add(HumanMessage(content=prompt))
+        return self.__submit_conversation(self.conversation)
     
     def reset(self, instruction_prompt = "default"):
         """Clear the old conversation and start a new conversation."""
@@ -194,59 +374,436 @@ class ChatBot():
         self.__initialize()
 
 
-    def __submit_conversation(self):
-        response = self.llm.predict_messages(self.messages, tools = self.functions if len(self.functions) >0 else None)
-        #print(response)
+    def __submit_conversation(self, conversation):
+        """Runs the agent loop until the LLM answers or a budget runs out, at which point a final answer is forced."""
+        with self.tracer.span('run', self.model, conversation.conversation_id, endpoint_type = self.endpoint_type):
+            budget = RunBudget(self.max_tool_rounds, self.max_tokens, self.request_timeout)
+            tools = self.__select_tools(conversation)
+            while True:
+                exhausted = budget.exhausted()
+                if exhausted:
+                    return self.__force_final_answer(conversation, budget, exhausted)
+
+                messages = self.__llm_messages(conversation, tools)
+                if messages is None:
+                    return self.__force_final_answer(conversation, budget, 'max_context_tokens')
+
+                response = self.__call_llm(conversation, messages, tools)
+                budget.add_usage(response)
+
+                tool_calls = response.additional_kwargs.get('tool_calls', None)
+                if not tool_calls:
+                    return self.__process_llm_response(conversation, response.content)
+
+                self.__process_tool_calls(conversation, tool_calls, response.additional_kwargs, budget)
+                budget.add_round()
+
+    def __call_llm(self, conversation, messages, tools):
+        with self.__llm_span(conversation, messages, tools) as span, conversation_scope(conversation):
+            response = self.llm.predict_messages(messages, tools = tools)
+            self.__record_usage(conversation, span, response)
+        return response
+
+    async def __acall_llm(self, conversation, messages, tools):
+        with self.__llm_span(conversation, messages, tools) as span, conversation_scope(conversation):
+            response = await self.llm.apredict_messages(messages, tools = tools)
+            self.__record_usage(conversation, span, response)
+        return response
 
-        response_content = response.content
-        #response_function = response.additional_kwargs['function_call'] if 'function_call' in response.additional_kwargs else None
+    def __llm_span(self, conversation, messages, tools):
+        return self.tracer.span('llm', self.model, conversation.conversation_id, 
+                                messages = len(messages), 
+                                payload_chars = sum(len(str(m.content)) for m in messages), 
+                                tools = len(tools) if tools else 0)
+
+    def __record_usage(self, conversation, span, response):
+        prompt_tokens, completion_tokens = token_usage(response)
         tool_calls = response.additional_kwargs.get('tool_calls', None)
-        finish_reason = response.additional_kwargs.get('finish_reason', 'stop')
-
-        if tool_calls == None:
-            return self.__process_llm_response(response_content)
-        #elif response_function['name'] != "question":
-        #    return self.__process_function_call(response.additional_kwargs, response_function)
-        elif tool_calls:
-            return self.__process_tool_calls(tool_calls, response.additional_kwargs)
-        #elif response_function['name'] == "question":
-        #    return self.__process_llm_response(response_function['arguments'])
-        else:
-            #catch all
-            return self.__process_llm_response(response_content)
+        model = response.response_metadata.get('provider_model', self.model)
+        cost = self.price_table.cost(model, prompt_tokens, completion_tokens)
+        conversation.usage.add_call(model, prompt_tokens, completion_tokens, cost, [t['function']['name'] for t in tool_calls or []])
+        span.set(prompt_tokens = prompt_tokens, completion_tokens = completion_tokens, 
+                 response_chars = len(str(response.content)), tool_calls = len(tool_calls) if tool_calls else 0)
+        if 'provider' in response.response_metadata:
+            #set by the router
+            span.set(provider = response.response_metadata['provider'], 
+                     failovers = response.response_metadata['failovers'], 
+                     hedged = response.response_metadata['hedged'])
+
+    def __estimated_usage(self, messages, response):
+        prompt = ''.join(str(m.content) for m in messages)
+        completion = str(response.content) + ''.join(t['function']['arguments'] for t in response.additional_kwargs.get('tool_calls', None) or [])
+        return {'prompt_tokens': count_text_tokens(prompt), 'completion_tokens': count_text_tokens(completion), 'estimated': True}
+
+    def __select_tools(self, conversation):
+        """The tool definitions sent to the LLM for this run, or None when there are no tools."""
+        if len(self.functions) == 0:
+            return None
+        if self.tool_selector is None:
+            return self.functions
+
+        query = next((r.message.content for r in reversed(conversation.records) if r.message.type == 'human'), '')
+        with self.tracer.span('tool_selection', self.model, conversation.conversation_id, available = len(self.functions)) as span:
+            try:
+                tools = self.tool_selector.select(self.functions, query)
+            except Exception as e:
+                #selection is an optimization, fall back to sending every tool
+                print(f'Tool selection failed, sending all tools: {e}')
+                tools = self.functions
+            span.set(selected = len(tools))
+        return tools
+
+    def __llm_messages(self, conversation, tools, final = False):
+        """The part of the thread sent to the LLM, ending with the final answer prompt if final is set. None when it
+        doesn't fit in max_context_tokens."""
+        prompt = [HumanMessage(content=self.__FINAL_ANSWER_PROMPT)] if final else []
+        if self.context_window is None:
+            return conversation.messages + prompt
+        overhead = self.__tool_tokens(tools) + sum(self.context_window.count_tokens(m) for m in prompt)
+        try:
+            return self.context_window.apply(conversation.messages, overhead) + prompt
+        except ContextOverflow as e:
+            print(f'Context overflow: {e}')
+            return None
+
+    def __tool_tokens(self, tools):
+        """Tokens the tool definitions add to an LLM call: the text tool protocol prompt (sent even without tools, for the
+        output tool) or the tool specs."""
+        if self.text_tool_protocol:
+            return count_text_tokens(tool_parser.tool_prompt(tools))
+        if not tools:
+            return 0
+        return count_text_tokens(json.dumps(tools))
+
+    def __force_final_answer(self, conversation, budget, reason):
+        print(f'Budget {reason} exhausted after {budget.tool_rounds} tool rounds, {budget.total_tokens} tokens and {budget.elapsed():.1f}s. Forcing a final answer...')
+        messages = self.__llm_messages(conversation, None, final = True) if reason != 'timeout' else None
+        if messages is None:
+            #no time left for another LLM round trip, or the thread doesn't fit in the context even without the tools
+            return self.__process_llm_response(conversation, self.budget_exhausted_message)
+
+        response = self.__call_llm(conversation, messages, None)
+        budget.add_usage(response)
+        return self.__process_llm_response(conversation, self.__final_answer_content(response))
+
+    def __final_answer_content(self, response):
+        if response.additional_kwargs.get('tool_calls', None) or not response.content:
+            return self.budget_exhausted_message
+        return response.content
+
+    def __stream_conversation(self, conversation):
+        with self.tracer.span('run', self.model, conversation.conversation_id, endpoint_type = self.endpoint_type):
+            budget = RunBudget(self.max_tool_rounds, self.max_tokens, self.request_timeout)
+            tools = self.__select_tools(conversation)
+            while True:
+                exhausted = budget.exhausted()
+                if exhausted:
+                    yield from self.__stream_final_answer(conversation, budget, exhausted)
+                    return
+
+                messages = self.__llm_messages(conversation, tools)
+                if messages is None:
+                    yield from self.__stream_final_answer(conversation, budget, 'max_context_tokens')
+                    return
+
+                response = yield from self.__stream_llm(conversation, messages, tools)
+                budget.add_usage(response)
+
+                tool_calls = response.additional_kwargs.get('tool_calls', None)
+                if not tool_calls:
+                    yield {'type': 'done', 'content': self.__process_llm_response(conversation, response.content)}
+                    return
+
+                for tool in tool_calls:
+                    yield {'type': 'tool_call', 'id': tool['id'], 'name': tool['function']['name'], 'arguments': tool['function']['arguments']}
+                self.__process_tool_calls(conversation, tool_calls, response.additional_kwargs, budget)
+                for msg in [r.message for r in conversation.records[-len(tool_calls):]]:
+                    yield {'type': 'tool_result', 'id': msg.tool_call_id, 'name': msg.name, 'content': msg.content}
+                budget.add_round()
+
+    def __stream_final_answer(self, conversation, budget, reason):
+        print(f'Budget {reason} exhausted after {budget.tool_rounds} tool rounds, {budget.total_tokens} tokens and {budget.elapsed():.1f}s. Forcing a final answer...')
+        messages = self.__llm_messages(conversation, None, final = True) if reason != 'timeout' else None
+        if messages is None:
+            yield {'type': 'token', 'content': self.budget_exhausted_message}
+            yield {'type': 'done', 'content': self.__process_llm_response(conversation, self.budget_exhausted_message)}
+            return
 
-    def __process_tool_calls(self, tool_calls, kwargs):
-        self.__add_message(AIMessage(content = '', additional_kwargs = kwargs))
+        response = yield from self.__stream_llm(conversation, messages, None)
+        budget.add_usage(response)
+        content = self.__final_answer_content(response)
+        if content != response.content:
+            yield {'type': 'token', 'content': content}
+        yield {'type': 'done', 'content': self.__process_llm_response(conversation, content)}
+
+    def __stream_llm(self, conversation, messages, tools):
+        """Yields token events as the completion streams in and returns the assembled message."""
+        with self.__llm_span(conversation, messages, tools) as span, conversation_scope(conversation):
+            if hasattr(self.llm, 'stream_messages'):
+                chunks = self.llm.stream_messages(messages, tools = tools)
+            else:
+                chunks = self.llm.stream(messages, tools = tools)
+
+            response = None
+            for chunk in chunks:
+                if response is None:
+                    span.set(time_to_first_chunk = time.perf_counter() - span.start_perf)
+                if chunk.content:
+                    yield {'type': 'token', 'content': chunk.content}
+                response = chunk if response is None else response + chunk
+
+            if response is None:
+                response = AIMessage(content = '')
+
+            tool_calls = response.additional_kwargs.get('tool_calls', None)
+            if tool_calls:
+                #merged chunks carry a stream index on each tool call
+                response.additional_kwargs['tool_calls'] = [{'id': t['id'], 'type': 'function', 'function': t['function']} for t in tool_calls]
+            if token_usage(response) == (0, 0):
+                #some endpoints report no usage on streams, and text protocol streams are closed before it would arrive
+                response.response_metadata['usage'] = self.__estimated_usage(messages, response)
+            self.__record_usage(conversation, span, response)
+        return response
+
+    async def __asubmit_conversation(self, conversation):
+        with self.tracer.span('run', self.model, conversation.conversation_id, endpoint_type = self.endpoint_type):
+            budget = RunBudget(self.max_tool_rounds, self.max_tokens, self.request_timeout)
+            tools = await asyncio.get_running_loop().run_in_executor(None, self.__select_tools, conversation)
+            while True:
+                exhausted = budget.exhausted()
+                if exhausted:
+                    return await self.__aforce_final_answer(conversation, budget, exhausted)
+
+                messages = self.__llm_messages(conversation, tools)
+                if messages is None:
+                    return await self.__aforce_final_answer(conversation, budget, 'max_context_tokens')
+
+                response = await self.__acall_llm(conversation, messages, tools)
+                budget.add_usage(response)
+
+                tool_calls = response.additional_kwargs.get('tool_calls', None)
+                if not tool_calls:
+                    return self.__process_llm_response(conversation, response.content)
+
+                await self.__aprocess_tool_calls(conversation, tool_calls, response.additional_kwargs, budget)
+                budget.add_round()
+
+    async def __aforce_final_answer(self, conversation, budget, reason):
+        print(f'Budget {reason} exhausted after {budget.tool_rounds} tool rounds, {budget.total_tokens} tokens and {budget.elapsed():.1f}s. Forcing a final answer...')
+        messages = self.__llm_messages(conversation, None, final = True) if reason != 'timeout' else None
+        if messages is None:
+            return self.__process_llm_response(conversation, self.budget_exhausted_message)
+
+        response = await self.__acall_llm(conversation, messages, None)
+        budget.add_usage(response)
+        return self.__process_llm_response(conversation, self.__final_answer_content(response))
+
+    def __process_tool_calls(self, conversation, tool_calls, kwargs, budget):
+        """Runs all tool calls of an assistant turn concurrently and appends the results in the original order."""
+        conversation.add(AIMessage(content = '', additional_kwargs = kwargs), usage = conversation.usage.claim())
+        calls = []
         for tool in tool_calls:
+            call = self.__tool_call(budget, tool['function']['name'])
+            calls.append((self.tool_executor.submit(self.__process_function_call, conversation, tool['function'], call), call))
+
+        for tool, (future, call) in zip(tool_calls, calls):
             function = tool['function']
-            func_response = self.__process_function_call(function)
-            self.__add_message(ToolMessage(content = func_response, name = function['name'], tool_call_id = tool['id']))
-        return self.__submit_conversation()
+            try:
+                func_response = call.result(future)
+            except QueueTimeout:
+                func_response = self.__backend_busy(function['name'])
+            except ToolTimeout as e:
+                #the call is abandoned, tools that check for cancellation stop
+                func_response = self.__gave_up(function['name'], e)
+            conversation.add(ToolMessage(content = func_response, name = function['name'], tool_call_id = tool['id']))
+            conversation.usage.add_tool_result(function['name'], func_response)
+
+    def __tool_call(self, budget, name):
+        """A ToolCall with the tool's own timeout, bounded by the run's deadline."""
+        timeout = self.tool_timeout
+        entry = self.dispatch.get(name, None)
+        if entry is not None:
+            call_func, tool = entry
+            timeout = self.tool_timeouts.get(tool.name, getattr(call_func, 'tool_timeout', timeout))
+        return ToolCall(timeout, budget.deadline())
+
+    def __gave_up(self, name, e):
+        #only a tool that ran past its own timeout is charged to its backend's breaker. Calls that were still queued
+        #or that ran out of the run's time say nothing about the backend. 'busy' calls waited on a backend slot.
+        if e.reason == 'timeout':
+            print(f'Function {name} timed out after {e.seconds:.1f}s...')
+            entry = self.dispatch.get(name, None)
+            if entry is not None:
+                self.__breaker(entry[0]).record_failure()
+            return f'Error: the tool {name} did not respond within {e.seconds:.1f} seconds.'
+        if e.reason == 'busy':
+            return self.__backend_busy(name)
+        if e.reason == 'queued':
+            print(f'Function {name} was still queued when the run ran out of time...')
+            return f'Error: the tool {name} did not start before the request ran out of time.'
+        print(f'Function {name} was stopped because the run ran out of time...')
+        return f'Error: the tool {name} was stopped because the request ran out of time.'
+
+    def __backend_busy(self, name):
+        #waiting on our own limiter says nothing about the backend's health, so the breaker isn't charged
+        print(f'Function {name} timed out waiting for a backend slot...')
+        return f'Error: the tool {name} could not run because its backend is busy. Try again later.'
 
-    def __process_function_call(self, func):
+    def __breaker(self, call_func):
+        return get_breaker(backend_key(call_func), **self.circuit_breaker)
+
+    def __backend_limiter(self, call_func):
+        key = backend_key(call_func)
+        limit = self.backend_limits.get(key, self.backend_limits.get(key.split(':')[0], self.max_backend_calls))
+        return get_backend_limiter(key, limit) if limit else None
+
+    def __call_tool(self, conversation, call_func, args, call, span):
+        """Runs a tool method on this thread, within its backend's concurrency limit."""
+        call.pick_up()
+        limiter = self.__backend_limiter(call_func)
+        if limiter is not None:
+            span.set(queue_wait = limiter.acquire(conversation.conversation_id, call.time_left()))
+        if call.cancel.is_set():
+            #the caller gave up while this call was queued
+            if limiter is not None:
+                limiter.release()
+            raise ToolCancelled('The tool call was cancelled before it started.')
+        call.invoked = True
+        try:
+            if inspect.iscoroutinefunction(call_func):
+                #async tool methods get their own event loop on the tool thread
+                return run_cancellable(call.cancel, lambda: asyncio.run(call_func(**args)))
+            return run_cancellable(call.cancel, call_func, **args)# if args != '{}' else call_func()
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    async def __acall_tool(self, conversation, call_func, args, call, span):
+        call.pick_up()
+        limiter = self.__backend_limiter(call_func)
+        if limiter is None:
+            call.invoked = True
+            return await call_func(**args)
+        span.set(queue_wait = await limiter.aacquire(conversation.conversation_id, call.time_left()))
+        call.invoked = True
+        try:
+            return await call_func(**args)
+        finally:
+            limiter.release()
+
+    def __unavailable(self, name, breaker):
+        print(f'Circuit open for {name}, skipping the call...')
+        return f'Error: the tool {name} is unavailable after repeated failures. Do not call it again for {breaker.retry_in():.0f} seconds.'
+
+    async def __aprocess_tool_calls(self, conversation, tool_calls, kwargs, budget):
+        conversation.add(AIMessage(content = '', additional_kwargs = kwargs), usage = conversation.usage.claim())
+        results = await asyncio.gather(*[self.__aprocess_function_call(conversation, tool['function'], self.__tool_call(budget, tool['function']['name'])) for tool in tool_calls])
+        for tool, func_response in zip(tool_calls, results):
+            conversation.add(ToolMessage(content = func_response, name = tool['function']['name'], tool_call_id = tool['id']))
+            conversation.usage.add_tool_result(tool['function']['name'], func_response)
+
+    def __resolve_function(self, func):
         call = func['name']
         #print(f'tool: {call}')
 
         #functions are patterned as helper_<index>--<function_name>
-        function_name = call.split('--')[1]
-        helper_ind = int(call.split('--')[0].split('_')[1])
-
-        helper = self.helpers[helper_ind]
+        entry = self.dispatch.get(call, None)
+        if entry is None:
+            raise ValueError(f'Unknown tool: {call}')
+        call_func, tool = entry
       
         args = func['arguments']
-        print(f'Calling function {function_name} with arguments {args}...')
-        #check the function name and run it against the helper
-        call_func = getattr(helper, function_name)
-        ret = call_func(**json.loads(args, strict=False))# if args != '{}' else call_func()
+        print(f'Calling function {tool.name} with arguments {args}...')
+        return call_func, tool.coerce_arguments(json.loads(args, strict=False) if args else {})
 
-        return ret
+    def __process_function_call(self, conversation, func, call):
+        with self.tracer.span('tool', func['name'], conversation.conversation_id, argument_chars = len(func['arguments'])) as span:
+            call_func, args = self.__resolve_function(func)
+            key, ttl, ret = self.__cached_result(call_func, args)
+            span.set(cached = ret is not None)
+            if key is None or ret is None:
+                breaker = self.__breaker(call_func)
+                if not breaker.allow():
+                    span.set(short_circuited = True)
+                    return self.__unavailable(func['name'], breaker)
+                try:
+                    ret = self.__call_tool(conversation, call_func, args, call, span)
+                except (ToolCancelled, QueueTimeout):
+                    #a tool that ran past its timeout is charged by the caller, anything else isn't the backend's fault
+                    breaker.record_abandoned()
+                    raise
+                except Exception:
+                    if call.cancel.is_set():
+                        breaker.record_abandoned()
+                    else:
+                        breaker.record_failure()
+                    raise
+                if call.cancel.is_set():
+                    #the caller gave up on this call and already settled it with the breaker, a late result doesn't undo that
+                    breaker.record_abandoned()
+                else:
+                    breaker.record_success()
+                if key is not None:
+                    tool_cache.put(key, ret, ttl)
+
+            ret = self.output_shaper.shape(func['name'], ret)
+            span.set(result_chars = len(ret))
+            return ret
 
         #return self.__process_function_response(function_name, ret)
 
-    def __process_llm_response(self, resp):
+    async def __aprocess_function_call(self, conversation, func, call):
+        with self.tracer.span('tool', func['name'], conversation.conversation_id, argument_chars = len(func['arguments'])) as span:
+            call_func, args = self.__resolve_function(func)
+            key, ttl, ret = self.__cached_result(call_func, args)
+            span.set(cached = ret is not None)
+            if key is None or ret is None:
+                breaker = self.__breaker(call_func)
+                if not breaker.allow():
+                    span.set(short_circuited = True)
+                    return self.__unavailable(func['name'], breaker)
+                if inspect.iscoroutinefunction(call_func):
+                    work = self.__acall_tool(conversation, call_func, args, call, span)
+                else:
+                    #sync tool methods run on the bounded tool pool
+                    work = asyncio.get_running_loop().run_in_executor(self.tool_executor, functools.partial(self.__call_tool, conversation, call_func, args, call, span))
+                try:
+                    ret = await call.aresult(work)
+                except QueueTimeout:
+                    span.set(timed_out = True)
+                    breaker.record_abandoned()
+                    return self.__backend_busy(func['name'])
+                except ToolTimeout as e:
+                    span.set(timed_out = True)
+                    if e.reason != 'timeout':
+                        breaker.record_abandoned()
+                    return self.__gave_up(func['name'], e)
+                except Exception:
+                    breaker.record_failure()
+                    raise
+                breaker.record_success()
+                if key is not None:
+                    tool_cache.put(key, ret, ttl)
+
+            ret = self.output_shaper.shape(func['name'], ret)
+            span.set(result_chars = len(ret))
+            return ret
+
+    def __cached_result(self, call_func, args):
+        """Returns (cache key, ttl, cached result). The key is None when the function isn't cacheable."""
+        ttl = tool_cache.ttl(call_func, self.tool_cache_ttls)
+        if ttl is None:
+            return None, None, None
+        key = tool_cache.key(call_func, args)
+        found, ret = tool_cache.get(key)
+        if found:
+            print(f'Using cached result for {call_func.__name__}...')
+        return key, ttl, ret if found else None
+
+    def __process_llm_response(self, conversation, resp):
       print(f'LLM Response {resp}...')
-      self.__add_message(AIMessage(content = resp))
-      self.__log_conversation()
+      conversation.add(AIMessage(content = resp), usage = conversation.usage.claim())
+      self.__log_conversation(conversation)
       return resp
         
 
@@ -255,41 +812,8 @@ class ChatBot():
         """
         Parses all internal functions of the object and returns an array of function definitions
         """
-        definitions = []
-        for name, func in object.__class__.__dict__.items():
-            if callable(func) and not name.startswith('_') and name != 'function_definitions':#not in ['__module__', '__doc__', '__qualname__', '__dict__']:
-                parameters = {}
-                required = []
-                for parameter in inspect.signature(func).parameters.values():
-                    if parameter.name != 'self':
-                      #print(parameter.annotation.__name__)
-                      parameters[parameter.name] = {
-                          #'name': parameter.name,
-                          'type': self.__param_type(parameter.annotation.__name__)
-                      }
-                      if parameter.default is parameter.empty:
-                          required.append(parameter.name)
-                desc = func.__doc__.strip() if func.__doc__ != None else ''
-                if hasattr(object, 'function_descriptor'):
-                    desc = f'{object.function_descriptor} \n\n{desc}'
-                definitions.append({
-                    'type': 'function',
-                    'function': {
-                        'name': name_prefix + name,
-                        'description': desc,
-                        'parameters': {"type": "object", "properties": parameters, 'required': required},
-                    }
-                })
+        definitions, dispatch = tool_registry.register(object, name_prefix)
         return definitions
-      
-
-    def __param_type(self, defined_type):
-      if defined_type == 'str':
-        return 'string'
-      elif defined_type == 'int':
-        return 'integer'
-      else:
-        return defined_type
 
 #test = lcChatBot()
 #print(test.function_definitions())
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def cacheable(ttl = 300):
+  """Marks a tool method whose result can be reused for identical arguments for ttl seconds."""
+  def mark(func):
+    func.cache_ttl = ttl
+    return func
+  return mark
+
+
+def not_cacheable(func):
+  """Marks a tool method that must never be served from the cache, even if the agent config opts it in."""
+  func.cache_ttl = False
+  return func
+
+
+class ToolCache():
+  """Process-wide LRU cache of tool results keyed by helper, function name and canonicalized arguments."""
+
+  def __init__(self, max_entries = 1024):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.hits = {}
+    self.misses = {}
+    self.lock = threading.Lock()
+
+  def ttl(self, call_func, overrides = {}):
+    """The TTL for a bound tool method, or None if its results are not cached.
+
+    A method decorated with not_cacheable is never cached. Otherwise overrides (function name to ttl) win over the
+    ttl set with the cacheable decorator. A ttl of 0 disables caching."""
+    marked = getattr(call_func, 'cache_ttl', None)
+    if marked is False:
+      return None
+    return overrides.get(call_func.__name__, marked) or None
+
+  def key(self, call_func, args):
+    helper = call_func.__self__
+    #two instances of a tool pointing at different schemas or indexes must not share results
+    scope = {k: v for k, v in vars(helper).items() if isinstance(v, (str, int, float, bool, list, tuple)) or v is None}
+    return (type(helper).__qualname__, json.dumps(scope, sort_keys=True, default=str), call_func.__name__, json.dumps(args, sort_keys=True, default=str))
+
+  def get(self, key):
+    """Returns (found, value)."""
+    counter = key[0] + '.' + key[2]
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] > time.monotonic():
+        self.entries.move_to_end(key)
+        self.hits[counter] = self.hits.get(counter, 0) + 1
+        return True, entry[1]
+      if entry is not None:
+        del self.entries[key]
+      self.misses[counter] = self.misses.get(counter, 0) + 1
+      return False, None
+
+  def put(self, key, value, ttl):
+    with self.lock:
+      self.entries[key] = (time.monotonic() + ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def stats(self):
+    """Hit and miss counts per tool function."""
+    with self.lock:
+      names = set(self.hits.keys()) | set(self.misses.keys())
+      return {n: {'hits': self.hits.get(n, 0), 'misses': self.misses.get(n, 0)} for n in sorted(names)}
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.hits = {}
+      self.misses = {}
+
+
+tool_cache = ToolCache()
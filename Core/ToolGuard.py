@@ -0,0 +1,189 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import json
+import threading
+import time
+
+
+class ToolCancelled(Exception):
+  """Raised inside a tool that checks check_cancelled() after its call was abandoned."""
+  pass
+
+
+def tool_timeout(seconds):
+  """Marks a tool method with its own timeout in seconds, instead of the agent's tool_timeout."""
+  def mark(func):
+    func.tool_timeout = seconds
+    return func
+  return mark
+
+
+_cancel_event = contextvars.ContextVar('tool_cancel_event', default = None)
+
+def cancelled():
+  """True when the tool call running on this thread (or task) has been abandoned by the agent."""
+  event = _cancel_event.get()
+  return event is not None and event.is_set()
+
+def check_cancelled():
+  """Long running tools call this between steps so an abandoned call stops instead of holding a worker."""
+  if cancelled():
+    raise ToolCancelled('The tool call was cancelled.')
+
+def run_cancellable(event, func, *args, **kwargs):
+  """Runs func with event as the cancellation signal seen by cancelled() and check_cancelled()."""
+  token = _cancel_event.set(event)
+  try:
+    return func(*args, **kwargs)
+  finally:
+    _cancel_event.reset(token)
+
+
+class ToolTimeout(TimeoutError):
+  """Raised when the agent gives up on a tool call. reason is 'timeout' when the tool ran past its own timeout,
+  'deadline' when the run ran out of time while the tool was running, 'busy' when it was still waiting for a backend
+  slot and 'queued' when no worker had started on it yet."""
+
+  def __init__(self, message, reason, seconds = None):
+    super().__init__(message)
+    self.reason = reason
+    self.seconds = seconds
+
+
+class ToolCall():
+  """A tool call handed to a worker. The tool's own timeout counts from when the worker starts on the call (pick_up),
+  so time spent queued for a worker doesn't count against it, while the run's deadline bounds the whole wait."""
+
+  def __init__(self, timeout = None, deadline = None):
+    self.timeout = timeout
+    self.deadline = deadline
+    self.cancel = threading.Event()
+    self.picked_up = concurrent.futures.Future()
+    #set once the tool itself is running, after any wait for a backend slot
+    self.invoked = False
+
+  def pick_up(self):
+    self.picked_up.set_result(time.monotonic())
+
+  def time_left(self):
+    """Seconds left for the call, or None when nothing limits it."""
+    limits = [] if self.deadline is None else [self.deadline]
+    if self.timeout is not None and self.picked_up.done():
+      limits.append(self.picked_up.result() + self.timeout)
+    return max(0.0, min(limits) - time.monotonic()) if len(limits) > 0 else None
+
+  def __until_deadline(self):
+    return max(0.0, self.deadline - time.monotonic()) if self.deadline is not None else None
+
+  def result(self, future):
+    """Waits for the future running the call. Returns its result or raises ToolTimeout once the call is given up on."""
+    concurrent.futures.wait([future, self.picked_up], timeout = self.__until_deadline(), return_when = concurrent.futures.FIRST_COMPLETED)
+    try:
+      return future.result(timeout = self.time_left())
+    except concurrent.futures.TimeoutError:
+      if future.done():
+        #the tool raised a timeout of its own, or finished just as the wait ran out
+        return future.result()
+    future.cancel()
+    raise self.give_up()
+
+  async def aresult(self, awaitable):
+    """Async version of result."""
+    future = asyncio.ensure_future(awaitable)
+    await asyncio.wait([future, asyncio.wrap_future(self.picked_up)], timeout = self.__until_deadline(), return_when = asyncio.FIRST_COMPLETED)
+    if not future.done():
+      await asyncio.wait([future], timeout = self.time_left())
+    if future.done():
+      return future.result()
+    future.cancel()
+    raise self.give_up()
+
+  def give_up(self):
+    """Signals the tool to stop and returns the ToolTimeout explaining why the call was given up on."""
+    self.cancel.set()
+    if not self.picked_up.done():
+      return ToolTimeout('The tool call never started.', 'queued')
+    if not self.invoked:
+      return ToolTimeout('The tool call was still waiting for a backend slot.', 'busy')
+    if self.timeout is not None and (self.deadline is None or self.picked_up.result() + self.timeout <= self.deadline):
+      return ToolTimeout(f'The tool call did not finish within {self.timeout:.1f}s.', 'timeout', self.timeout)
+    return ToolTimeout('The run ran out of time.', 'deadline')
+
+
+class CircuitBreaker():
+  """Stops calling a backend after failure_threshold consecutive failures.
+
+  While open, calls are refused for reset_timeout seconds. After that one trial call is let through (half open): a
+  success closes the breaker, a failure opens it again."""
+
+  def __init__(self, failure_threshold = 5, reset_timeout = 30):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.failures = 0
+    self.opened_at = None
+    self.trial_running = False
+    self.lock = threading.Lock()
+
+  @property
+  def state(self):
+    with self.lock:
+      if self.opened_at is None:
+        return 'closed'
+      return 'half_open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+  def allow(self):
+    with self.lock:
+      if self.opened_at is None:
+        return True
+      if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_running:
+        return False
+      self.trial_running = True
+      return True
+
+  def retry_in(self):
+    """Seconds until the next trial call is allowed."""
+    with self.lock:
+      if self.opened_at is None:
+        return 0.0
+      return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+  def record_success(self):
+    with self.lock:
+      self.failures = 0
+      self.opened_at = None
+      self.trial_running = False
+
+  def record_abandoned(self):
+    """A call that was cancelled before it could tell anything about the backend. Frees the trial slot when half open."""
+    with self.lock:
+      self.trial_running = False
+
+  def record_failure(self):
+    with self.lock:
+      self.failures += 1
+      if self.trial_running or self.failures >= self.failure_threshold:
+        self.opened_at = time.monotonic()
+      self.trial_running = False
+
+
+def backend_key(call_func):
+  """Identifies the backend behind a bound tool method. Helpers can name it with a backend attribute (for example the
+  warehouse id), otherwise the helper's class and simple settings are used, so equally configured helpers share a breaker."""
+  helper = getattr(call_func, '__self__', None)
+  backend = getattr(helper, 'backend', None)
+  if backend is not None:
+    return str(backend)
+  scope = {k: v for k, v in vars(helper).items() if isinstance(v, (str, int, float, bool, list, tuple)) or v is None} if helper is not None else {}
+  return f'{type(helper).__qualname__}:{json.dumps(scope, sort_keys=True, default=str)}'
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(key, failure_threshold = 5, reset_timeout = 30):
+  """The process-wide CircuitBreaker for a backend, shared by every conversation in the process."""
+  with _breakers_lock:
+    if key not in _breakers:
+      _breakers[key] = CircuitBreaker(failure_threshold, reset_timeout)
+    return _breakers[key]
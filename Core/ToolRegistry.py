@@ -0,0 +1,125 @@
+import inspect
+import json
+import threading
+import typing
+
+
+def json_schema(annotation):
+  """Maps a python annotation to a JSON Schema. Unannotated parameters are treated as strings."""
+  if annotation is inspect.Parameter.empty or annotation is str or annotation is typing.Any:
+    return {'type': 'string'}
+  if annotation is bool:
+    return {'type': 'boolean'}
+  if annotation is int:
+    return {'type': 'integer'}
+  if annotation is float:
+    return {'type': 'number'}
+  if annotation is dict:
+    return {'type': 'object'}
+  if annotation is list or annotation is tuple:
+    return {'type': 'array', 'items': {'type': 'string'}}
+
+  origin = typing.get_origin(annotation)
+  args = [a for a in typing.get_args(annotation) if a is not type(None)]
+  if origin in (list, tuple, set):
+    return {'type': 'array', 'items': json_schema(args[0]) if len(args) > 0 else {'type': 'string'}}
+  if origin is dict:
+    return {'type': 'object'}
+  if origin is typing.Union or type(annotation).__name__ == 'UnionType':
+    #Optional[X] is X, other unions list every option
+    if len(args) == 1:
+      return json_schema(args[0])
+    return {'anyOf': [json_schema(a) for a in args]}
+  if origin is typing.Literal:
+    return {'type': 'string', 'enum': [str(a) for a in typing.get_args(annotation)]}
+  return {'type': 'string'}
+
+
+def coerce(value, schema):
+  """Converts an argument sent by the LLM (often a string) to the type described by schema."""
+  if value is None:
+    return value
+  kind = schema.get('type', None)
+  try:
+    if kind == 'integer' and not isinstance(value, int):
+      return int(float(value))
+    if kind == 'number' and not isinstance(value, (int, float)):
+      return float(value)
+    if kind == 'boolean' and not isinstance(value, bool):
+      return str(value).strip().lower() in ('true', '1', 'yes', 'y')
+    if kind == 'array' and isinstance(value, str):
+      value = value.strip()
+      items = json.loads(value) if value.startswith('[') else [v.strip() for v in value.split(',') if v.strip() != '']
+      return [coerce(v, schema.get('items', {})) for v in items]
+    if kind == 'array' and isinstance(value, list):
+      return [coerce(v, schema.get('items', {})) for v in value]
+    if kind == 'object' and isinstance(value, str):
+      return json.loads(value)
+  except (ValueError, TypeError):
+    #leave the value as sent and let the tool report the problem
+    pass
+  return value
+
+
+class ToolFunction():
+  """Introspected signature of one tool method. Built once per tool class."""
+
+  __slots__ = ['name', 'doc', 'properties', 'required', 'is_async']
+
+  def __init__(self, name, func):
+    self.name = name
+    self.doc = func.__doc__.strip() if func.__doc__ != None else ''
+    self.properties = {}
+    self.required = []
+    for parameter in inspect.signature(func).parameters.values():
+      if parameter.name == 'self':
+        continue
+      self.properties[parameter.name] = json_schema(parameter.annotation)
+      if parameter.default is parameter.empty:
+        self.required.append(parameter.name)
+    self.is_async = inspect.iscoroutinefunction(func)
+
+  def definition(self, name_prefix, descriptor = None):
+    desc = f'{descriptor} \n\n{self.doc}' if descriptor is not None else self.doc
+    return {
+      'type': 'function',
+      'function': {
+        'name': name_prefix + self.name,
+        'description': desc,
+        'parameters': {"type": "object", "properties": self.properties, 'required': self.required},
+      }
+    }
+
+  def coerce_arguments(self, args):
+    return {k: coerce(v, self.properties[k]) if k in self.properties else v for k, v in args.items()}
+
+
+class ToolRegistry():
+  """Process-wide cache of the tool functions of each tool class, so classes are introspected only once."""
+
+  def __init__(self):
+    self.classes = {}
+    self.lock = threading.Lock()
+
+  def tool_functions(self, cls):
+    functions = self.classes.get(cls)
+    if functions is None:
+      #public callables defined on the class itself are exposed as tools
+      functions = [ToolFunction(name, func) for name, func in cls.__dict__.items()
+                   if callable(func) and not name.startswith('_') and name != 'function_definitions']
+      with self.lock:
+        self.classes[cls] = functions
+    return functions
+
+  def register(self, helper, name_prefix = ''):
+    """Returns the definitions for the helper's tools and a dispatch table from tool name to (bound method, ToolFunction)."""
+    descriptor = getattr(helper, 'function_descriptor', None)
+    definitions = []
+    dispatch = {}
+    for tool in self.tool_functions(helper.__class__):
+      definitions.append(tool.definition(name_prefix, descriptor))
+      dispatch[name_prefix + tool.name] = (getattr(helper, tool.name), tool)
+    return definitions, dispatch
+
+
+tool_registry = ToolRegistry()
@@ -0,0 +1,47 @@
+import threading
+
+import numpy as np
+
+
+class ToolSelector():
+  """Picks the tools worth sending to the LLM for a request, so agents with many tools don't pay for every spec each turn.
+
+  Tool names and descriptions are embedded once. Each request embeds the latest user message and keeps the top_k tools
+  by cosine similarity, plus the pinned tools (full or short function names) which are always sent. embeddings is any
+  object with embed_documents(texts) and embed_query(text), such as the langchain embedding clients."""
+
+  def __init__(self, embeddings, top_k = 8, pinned = []):
+    self.embeddings = embeddings
+    self.top_k = top_k
+    self.pinned = set(pinned)
+    self.__index = None
+    self.__indexed = None
+    self.lock = threading.Lock()
+
+  def select(self, functions, query):
+    """Returns the subset of functions (openai tool definitions) to send for query, in their original order."""
+    if len(functions) <= self.top_k or not query:
+      return functions
+
+    matrix = self.__tool_index(functions)
+    vector = np.asarray(self.embeddings.embed_query(query), dtype = np.float32)
+    scores = matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+
+    keep = set(int(i) for i in np.argsort(-scores)[:self.top_k])
+    for i, f in enumerate(functions):
+      name = f['function']['name']
+      if name in self.pinned or name.split('--')[-1] in self.pinned:
+        keep.add(i)
+    return [f for i, f in enumerate(functions) if i in keep]
+
+  def __tool_index(self, functions):
+    #the tool list of a ChatBot is fixed once its helpers are added, so it is embedded once
+    names = [f['function']['name'] for f in functions]
+    with self.lock:
+      if self.__indexed != names:
+        texts = [f"{f['function']['name'].split('--')[-1]}: {f['function'].get('description', '')}" for f in functions]
+        matrix = np.asarray(self.embeddings.embed_documents(texts), dtype = np.float32)
+        norms = np.linalg.norm(matrix, axis = 1, keepdims = True)
+        self.__index = matrix / np.where(norms == 0, 1.0, norms)
+        self.__indexed = names
+      return self.__index
@@ -0,0 +1,82 @@
+from Core.Context import count_text_tokens
+
+
+#USD per million tokens. List prices at the time of writing, override or extend them with the 'prices' config.
+DEFAULT_PRICES = {
+  'gpt-3.5-turbo': {'prompt': 0.5, 'completion': 1.5},
+  'gpt-4-turbo': {'prompt': 10.0, 'completion': 30.0},
+  'gpt-4-turbo-preview': {'prompt': 10.0, 'completion': 30.0},
+  'gpt-4-1106-preview': {'prompt': 10.0, 'completion': 30.0},
+  'gpt-4-0125-preview': {'prompt': 10.0, 'completion': 30.0},
+  'gpt-4': {'prompt': 30.0, 'completion': 60.0},
+}
+
+
+class PriceTable():
+  """Estimates the cost of an LLM call from a table of model name to USD per million prompt and completion tokens.
+
+  A model without an exact entry uses the longest entry its name starts with (gpt-4-turbo-2024-04-09 is priced as
+  gpt-4-turbo). Calls to models that aren't in the table have no cost."""
+
+  def __init__(self, prices = {}):
+    self.prices = dict(DEFAULT_PRICES)
+    self.prices.update(prices)
+
+  def price(self, model):
+    if model in self.prices:
+      return self.prices[model]
+    matches = [name for name in self.prices.keys() if model.startswith(name)]
+    return self.prices[max(matches, key=len)] if len(matches) > 0 else None
+
+  def cost(self, model, prompt_tokens, completion_tokens):
+    price = self.price(model)
+    if price is None:
+      return None
+    return (prompt_tokens * price.get('prompt', 0.0) + completion_tokens * price.get('completion', 0.0)) / 1000000
+
+
+class Usage():
+  """Token usage and cost of one conversation: every LLM call (one per tool round) and the size of every tool result."""
+
+  def __init__(self):
+    self.calls = []
+    self.tools = {}
+    self.pending = None
+
+  def add_call(self, model, prompt_tokens, completion_tokens, cost, tool_calls = []):
+    """Records an LLM call. The entry is kept as pending until claim() attaches it to the assistant message."""
+    entry = {
+      'round': len(self.calls),
+      'model': model,
+      'prompt_tokens': prompt_tokens,
+      'completion_tokens': completion_tokens,
+      'cost': cost,
+      'tool_calls': list(tool_calls)
+    }
+    self.calls.append(entry)
+    self.pending = entry
+    return entry
+
+  def claim(self):
+    """Returns the usage of the last LLM call if no message has been given it yet."""
+    entry, self.pending = self.pending, None
+    return entry
+
+  def add_tool_result(self, name, content):
+    stats = self.tools.setdefault(name, {'calls': 0, 'result_tokens': 0})
+    stats['calls'] += 1
+    stats['result_tokens'] += count_text_tokens(str(content))
+
+  def summary(self):
+    prompt_tokens = sum(c['prompt_tokens'] for c in self.calls)
+    completion_tokens = sum(c['completion_tokens'] for c in self.calls)
+    costs = [c['cost'] for c in self.calls if c['cost'] is not None]
+    return {
+      'prompt_tokens': prompt_tokens,
+      'completion_tokens': completion_tokens,
+      'total_tokens': prompt_tokens + completion_tokens,
+      'cost': sum(costs) if len(costs) > 0 else None,
+      'unpriced_calls': len(self.calls) - len(costs),
+      'rounds': list(self.calls),
+      'tools': dict(self.tools)
+    }
@@ -5,6 +5,12 @@ import string
 import time
 import os
 
+from Core.ToolCache import not_cacheable
+from Core.ToolGuard import tool_timeout, cancelled, ToolCancelled
+
+#connect and read timeouts for Databricks REST calls
+REQUEST_TIMEOUT = (10, 60)
+
 class PythonExecutor():
   def __init__(self, cluster_id: str, working_directory: str):
     """Run Python scripts against a Databricks Cluster. Specify the cluster id and a working directory to load scripts into."""
@@ -12,6 +18,7 @@ class PythonExecutor():
     self.databricks_instance = os.getenv("DATABRICKS_HOST")
     self.cluster_id = cluster_id
     self.working_directory = working_directory
+    self.backend = f'cluster:{cluster_id}'
 
   def __create_python_notebook(self, content: str):
     """Creates a Databricks notebook and returns the file path."""
@@ -27,7 +34,7 @@ class PythonExecutor():
       "content": self.__to_base64(content),
       "overwrite": False
     }
-    response = requests.post(f'{self.databricks_instance}/api/2.0/workspace/import', headers=headers, json=payload)
+    response = requests.post(f'{self.databricks_instance}/api/2.0/workspace/import', headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 200:
         print(f'File Created: {file_path}')
@@ -61,7 +68,7 @@ class PythonExecutor():
     payload = {
       "path": file_path
     }
-    response = requests.post(f'{self.databricks_instance}/api/2.0/workspace/delete', headers=headers, json=payload)
+    response = requests.post(f'{self.databricks_instance}/api/2.0/workspace/delete', headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 200:
         return 'File Deleted.'
@@ -80,8 +87,16 @@ class PythonExecutor():
       print(result)
       if state != '':
         return f'{state}: {message}'
+      if cancelled():
+        #the agent gave up on this call, don't leave the run going on the cluster
+        self.__cancel_run(run_id)
+        raise ToolCancelled(f'Run {run_id} was cancelled.')
       time.sleep(5)
 
+  def __cancel_run(self, run_id: int):
+    headers = {'Authorization': f'Bearer {self.db_api_token}', 'Content-Type': 'application/json'}
+    requests.post(f'{self.databricks_instance}/api/2.1/jobs/runs/cancel', headers=headers, json={"run_id": run_id}, timeout=REQUEST_TIMEOUT)
+
   def __start_notebook_task(self, file_path: str):
     """Starts a Databricks notebook and returns the job_id."""
 
@@ -98,7 +113,7 @@ class PythonExecutor():
         }
       ]
     }
-    response = requests.post(f'{self.databricks_instance}/api/2.1/jobs/runs/submit', headers=headers, json=payload)
+    response = requests.post(f'{self.databricks_instance}/api/2.1/jobs/runs/submit', headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 200:
         job_id = response.json()['run_id']
@@ -110,7 +125,7 @@ class PythonExecutor():
   def __get_run_detail(self, run_id: int):
 
     headers = {'Authorization': f'Bearer {self.db_api_token}', 'Content-Type': 'application/json'}
-    response = requests.get(f'{self.databricks_instance}/api/2.0/jobs/runs/get?run_id={run_id}', headers=headers)
+    response = requests.get(f'{self.databricks_instance}/api/2.0/jobs/runs/get?run_id={run_id}', headers=headers, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 200:
         result = response.json()['state']
@@ -122,9 +137,13 @@ class PythonExecutor():
         error = response.json()
         raise ValueError(f'Error getting job status and result: {error}')
       
+  @not_cacheable
+  @tool_timeout(600)
   def run_python_script(self, script_content: str):
     """Runs a python script on a Databricks cluster."""
     file_path = self.__create_python_notebook(script_content)
-    run_result = self.__run_notebook(file_path)
-    self.__delete_python_notebook(file_path)
+    try:
+      run_result = self.__run_notebook(file_path)
+    finally:
+      self.__delete_python_notebook(file_path)
     return run_result
\ No newline at end of file
@@ -11,13 +11,22 @@ from databricks.vector_search.client import VectorSearchClient
 import pandas as pd
 import os
 
+from Core.ToolCache import cacheable, not_cacheable
+from Core.ToolGuard import tool_timeout
+
+#connect and read timeouts for Databricks REST calls
+REQUEST_TIMEOUT = (10, 60)
+
 class Executor():
   def __init__(self):
     """Tool that enables execution of any Databricks API endpoint."""
     self.db_api_token = os.getenv("DATABRICKS_TOKEN")
     self.databricks_instance = os.getenv("DATABRICKS_HOST")
     self.headers = {'Authorization': f'Bearer {self.db_api_token}', 'Content-Type': 'application/json'}
+    self.backend = f'databricks-api:{self.databricks_instance}'
   
+  @not_cacheable
+  @tool_timeout(90)
   def execute_databricks_api_command(self, relative_url: str, http_method: str = "GET", json_payload: str = None):
     """Executes a command against a Databricks API Endpoint. 
     relative_url: relative url path to the api endpoint. example - '/api/2.0/pipelines'
@@ -31,7 +40,7 @@ class Executor():
       except:
         payload = eval(json_payload)
     
-    response = requests.request(http_method.upper(),f'{self.databricks_instance}{relative_url}', headers = self.headers, json = payload)
+    response = requests.request(http_method.upper(),f'{self.databricks_instance}{relative_url}', headers = self.headers, json = payload, timeout = REQUEST_TIMEOUT)
 
     return response.text
 
@@ -44,6 +53,7 @@ class Search():
         self.databricks_instance = os.getenv("DATABRICKS_HOST")
         self.vector_search_endpoint_name = vector_search_endpoint_name
         self.index_name = index_name
+        self.backend = f'vector-search:{vector_search_endpoint_name}'
 
         self.vsc = VectorSearchClient(
             workspace_url=self.databricks_instance, 
@@ -57,6 +67,7 @@ class Search():
 
 
 
+    @cacheable(ttl=3600)
     def search_for_api(self, query_text: str):
         """This function retrieves 10 databricks apis by performing a similarity search against a vector database of Databricks API Documentation. To get detailed documentation for a particular api endpoint, use retrieve_api_doc.
         """
@@ -96,6 +107,7 @@ class Search():
 
         return dic
     
+    @cacheable(ttl=3600)
     def retrieve_api_doc(self, api_title: str):
         """This function retrieves the full documentation for the databricks api with the specified title. If the exact title isn't specified, an empty dataset will be returned - [].
         """
@@ -5,6 +5,12 @@ import string
 import time
 import os
 
+from Core.ToolCache import cacheable, not_cacheable
+from Core.ToolGuard import tool_timeout
+
+#connect and read timeouts for the statement API. Statements are cancelled server side after wait_timeout (30s).
+REQUEST_TIMEOUT = (10, 45)
+
 class UnityCatalog_Schema():
   def __init__(self, warehouse_id: str, catalog: str, schema: str):
     """Specify a UC Schema and navigate UC metadata to generate Text to SQL."""
@@ -13,7 +19,9 @@ class UnityCatalog_Schema():
     self.warehouse_id = warehouse_id
     self.catalog = catalog.lower()
     self.schema = schema.lower()
+    self.backend = f'sql-warehouse:{warehouse_id}'
   
+  @cacheable(ttl=300)
   def list_table(self):
     """Returns a list of all available tables."""
 
@@ -24,6 +32,7 @@ class UnityCatalog_Schema():
           """
     return self.run_sql_statement(sql, 100)
   
+  @cacheable(ttl=300)
   def table_definition(self, tables: str):
     """Receives a list of comma separated table names and returns table definitions for the tables."""
 
@@ -68,6 +77,8 @@ class UnityCatalog_Schema():
       
     return ret
 
+  @not_cacheable
+  @tool_timeout(60)
   def run_sql_statement(self, sql: str, row_limit: int=10):
     """Receives SQL, runs it, and returns the result. To limit the number of records returned, use the row_limit parameter. Do not limit it in the sql. """
     
@@ -82,7 +93,7 @@ class UnityCatalog_Schema():
       "row_limit": row_limit
     }
 
-    response = requests.post(f'{self.databricks_instance}/api/2.0/sql/statements/', headers=headers, json=payload)
+    response = requests.post(f'{self.databricks_instance}/api/2.0/sql/statements/', headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 200:
         result = response.json()
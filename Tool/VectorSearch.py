@@ -12,6 +12,7 @@ class Retriever():
         self.vector_search_endpoint_name = vector_search_endpoint_name
         self.index_name = index_name
         self.return_columns = return_columns
+        self.backend = f'vector-search:{vector_search_endpoint_name}'
 
         self.vsc = VectorSearchClient(
             workspace_url=self.databricks_instance, 
@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+import Core.Context
+import Core.Tool
+from Core.Context import ContextOverflow, ContextWindow, count_text_tokens
+from Core.Tool import ChatBot
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+
+OFFLINE_TIKTOKEN = '''
+import sys, types
+def get_encoding(name):
+  raise ConnectionError('no network')
+sys.modules['tiktoken'] = types.SimpleNamespace(get_encoding = get_encoding)
+'''
+
+
+def test_package_imports_when_the_encoding_cant_be_downloaded():
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  result = subprocess.run([sys.executable, '-c', OFFLINE_TIKTOKEN + 'import Core.Tool'], cwd = root, capture_output = True, text = True)
+  assert result.returncode == 0, result.stderr
+
+
+def test_token_counts_fall_back_to_an_estimate_offline(monkeypatch):
+  def get_encoding(name):
+    raise ConnectionError('no network')
+  monkeypatch.setitem(sys.modules, 'tiktoken', types.SimpleNamespace(get_encoding = get_encoding))
+  monkeypatch.setattr(Core.Context, '_encoding', None)
+  assert count_text_tokens('a' * 40) == 10
+
+
+def long_thread(turns, size):
+  messages = [SystemMessage(content = 'You are helpful.')]
+  for i in range(turns):
+    messages += [HumanMessage(content = f'question {i} ' + 'q' * size), AIMessage(content = f'answer {i} ' + 'a' * size)]
+  return messages
+
+
+def test_each_message_is_tokenized_once(monkeypatch):
+  counted = []
+  monkeypatch.setattr(Core.Context, 'count_text_tokens', lambda text: counted.append(text) or (len(text) + 3) // 4)
+  messages = long_thread(40, 400)
+  window = ContextWindow(max_tokens = 1000, summary_tokens = 100).apply(messages)
+  assert sum(ContextWindow().count_tokens(m) for m in window) <= 1000
+  #the turns, the summary lines and the rebuilt system message
+  assert len(counted) < 2 * len(messages)
+
+
+def test_last_turn_over_the_cap_is_cut():
+  window = ContextWindow(max_tokens = 300).apply(long_thread(1, 4000))
+  assert sum(ContextWindow().count_tokens(m) for m in window) <= 300
+  assert 'characters removed to save context' in window[-1].content
+
+
+def test_overflow_raises_when_nothing_can_be_cut():
+  with pytest.raises(ContextOverflow):
+    ContextWindow(max_tokens = 100).apply(long_thread(1, 10), overhead_tokens = 200)
+
+
+def test_chatbot_answers_with_the_budget_message_on_overflow(monkeypatch):
+  calls = []
+  class FakeLLM():
+    def predict_messages(self, messages, tools = None):
+      calls.append(messages)
+      return AIMessage(content = 'hello')
+  monkeypatch.setattr(Core.Tool, 'ChatOpenAI', lambda **kwargs: None)
+  bot = ChatBot({'model': 'test-model', 'max_context_tokens': 20, 'budget_exhausted_message': 'out of context'}, [])
+  bot.llm = FakeLLM()
+  conversation = bot.start_conversation([{'role': 'user', 'content': 'go ' * 100}])
+  bot.run_conversation(conversation)
+  assert calls == []
+  assert conversation.records[-1].message.content == 'out of context'
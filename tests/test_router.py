@@ -0,0 +1,72 @@
+import asyncio
+import concurrent.futures
+import time
+
+from Core.Router import LLMRouter, Provider
+
+
+class RateLimited(Exception):
+  status_code = 429
+
+
+class Response():
+  def __init__(self, content):
+    self.content = content
+    self.response_metadata = {}
+
+
+class FakeClient():
+  def __init__(self, name, seconds = 0.0, fail = False):
+    self.name = name
+    self.seconds = seconds
+    self.fail = fail
+
+  def predict_messages(self, messages, tools = None):
+    time.sleep(self.seconds)
+    if self.fail:
+      raise RateLimited('rate limited')
+    return Response(self.name)
+
+  async def apredict_messages(self, messages, tools = None):
+    await asyncio.sleep(self.seconds)
+    if self.fail:
+      raise RateLimited('rate limited')
+    return Response(self.name)
+
+
+def router(clients, **kwargs):
+  return LLMRouter([Provider(c.name, c) for c in clients], **kwargs)
+
+
+def test_queued_calls_are_not_charged_with_the_timeout():
+  r = router([FakeClient('a', 0.3), FakeClient('b', 0.3)], timeout = 0.5, hedge_after = 10, max_workers = 16)
+  with concurrent.futures.ThreadPoolExecutor(48) as pool:
+    answers = list(pool.map(lambda i: r.predict_messages([]).content, range(48)))
+  assert answers == ['a'] * 48
+  assert all(p.error_rate() == 0.0 for p in r.providers)
+
+
+def test_sync_timeout_is_charged_and_fails_over():
+  r = router([FakeClient('hang', 1.0), FakeClient('ok')], timeout = 0.1)
+  assert r.predict_messages([]).content == 'ok'
+  assert r.providers[0].errors == 1
+
+
+def test_async_timeout_is_charged_and_fails_over():
+  r = router([FakeClient('hang', 10.0), FakeClient('ok')], timeout = 0.1)
+
+  async def calls():
+    return [(await r.apredict_messages([])).content for _ in range(3)]
+
+  start = time.monotonic()
+  assert asyncio.run(calls()) == ['ok'] * 3
+  hang = r.providers[0]
+  assert hang.calls == 1 and hang.error_rate() == 1.0
+  #once its error rate is high, the hanging provider is tried last and later calls don't wait for it
+  assert time.monotonic() - start < 0.3
+
+
+def test_primary_failing_before_the_hedge_fails_over_to_the_hedge_provider():
+  r = router([FakeClient('a', fail = True), FakeClient('b')], hedge_after = 1.0)
+  assert r.predict_messages([]).content == 'b'
+  assert asyncio.run(r.apredict_messages([])).content == 'b'
@@ -0,0 +1,44 @@
+import pytest
+
+from Core.ChatConverter import StreamingToolParser
+
+
+COMPLETIONS = [
+  '<!tool:helper_x--output###content:Here is the answer!>',
+  'A plain answer without the protocol.',
+  '<!tool:helper_0--f###a:1!>',
+  '<!tool:helper_0--f###a:1!><!tool:helper_x--output###content:Here is the answer!>',
+  '<!tool:helper_0--f###a:1!> <!tool:helper_0--g###b:2###c:x\\_y!>',
+  '<!tool:helper_0--f###a:1!>\n<!tool:helper_1--h###q:select 1!> and some text after the calls',
+  '  <!tool:helper_x--output###content:snake\\_case and <b>!>',
+]
+
+
+def parse(text, chunk_size):
+  """Feeds text to a parser chunk_size characters at a time, stopping once the parser is finished like the stream does."""
+  parser = StreamingToolParser()
+  events = []
+  for i in range(0, len(text), chunk_size):
+    events += parser.feed(text[i:i + chunk_size])
+    if parser.finished:
+      return events
+  return events + parser.close()
+
+
+def normalized(events):
+  """Tool calls get random ids, so events are compared by name and arguments. Text is joined, chunking splits it."""
+  calls = [(e['function']['name'], e['function']['arguments']) for kind, e in events if kind == 'tool_call']
+  text = ''.join(e for kind, e in events if kind == 'text')
+  return calls, text
+
+
+@pytest.mark.parametrize('text', COMPLETIONS)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 8, 13])
+def test_chunked_matches_whole(text, chunk_size):
+  assert normalized(parse(text, chunk_size)) == normalized(parse(text, len(text)))
+
+
+def test_output_tool_after_tool_call_is_dropped():
+  calls, text = normalized(parse(COMPLETIONS[3], 1))
+  assert calls == [('helper_0--f', '{"a": "1"}')]
+  assert text == ''
@@ -0,0 +1,61 @@
+import json
+import time
+
+import Core.Tool
+from Core.Tool import ChatBot
+from Core.ToolGuard import get_breaker
+from langchain_core.messages import AIMessage
+
+
+class FakeLLM():
+  """Calls the tool once, then answers with the tool's result."""
+
+  def __init__(self, delay = 0.0):
+    self.delay = delay
+
+  def predict_messages(self, messages, tools = None):
+    time.sleep(self.delay)
+    if messages[-1].type == 'human':
+      tool_calls = [{'id': 'call_1', 'type': 'function', 'function': {'name': 'helper_0--work', 'arguments': json.dumps({'n': 1})}}]
+      return AIMessage(content = '', additional_kwargs = {'tool_calls': tool_calls})
+    return AIMessage(content = messages[-1].content)
+
+
+class SlowBackend():
+  def __init__(self, backend, seconds):
+    self.backend = backend
+    self.seconds = seconds
+
+  def work(self, n: int):
+    """Does some work."""
+    time.sleep(self.seconds)
+    return 'done'
+
+
+def make_bot(monkeypatch, config, helper, llm_delay = 0.0):
+  monkeypatch.setattr(Core.Tool, 'ChatOpenAI', lambda **kwargs: None)
+  bot = ChatBot(dict(config, model = 'test-model'), [helper])
+  bot.llm = FakeLLM(llm_delay)
+  return bot
+
+
+def run(bot):
+  conversation = bot.start_conversation([{'role': 'user', 'content': 'go'}])
+  bot.run_conversation(conversation)
+  return [r.message.content for r in conversation.records if r.message.type == 'tool']
+
+
+def test_late_completion_does_not_reset_breaker(monkeypatch):
+  bot = make_bot(monkeypatch, {'tool_timeout': 0.2, 'circuit_breaker': {'failure_threshold': 2}}, SlowBackend('test-late', 0.5))
+  for _ in range(2):
+    assert 'did not respond within 0.2 seconds' in run(bot)[0]
+    #the abandoned call finishes in the background
+    time.sleep(0.5)
+  assert get_breaker('test-late').state == 'open'
+
+
+def test_spent_run_deadline_is_not_charged(monkeypatch):
+  bot = make_bot(monkeypatch, {'request_timeout': 0.1, 'tool_timeout': 5}, SlowBackend('test-deadline', 0.0), llm_delay = 0.15)
+  for _ in range(6):
+    run(bot)
+  assert get_breaker('test-deadline').failures == 0
@@ -0,0 +1,26 @@
+import pytest
+
+import Core.Tool
+from Core.Tool import ChatBot
+from Core.ToolSelector import ToolSelector
+
+
+def make_bot(monkeypatch, selection):
+  monkeypatch.setattr(Core.Tool, 'ChatOpenAI', lambda **kwargs: None)
+  monkeypatch.setattr(Core.Tool, 'OpenAIEmbeddings', lambda **kwargs: object())
+  return ChatBot({'model': 'test-model', 'tool_selection': selection}, [])
+
+
+def test_tool_selection_true_uses_the_defaults(monkeypatch):
+  selector = make_bot(monkeypatch, True).tool_selector
+  assert isinstance(selector, ToolSelector)
+  assert selector.top_k == 8
+
+
+def test_tool_selection_options(monkeypatch):
+  assert make_bot(monkeypatch, {'top_k': 3}).tool_selector.top_k == 3
+
+
+def test_invalid_tool_selection_is_rejected(monkeypatch):
+  with pytest.raises(ValueError, match = 'tool_selection'):
+    make_bot(monkeypatch, 'yes')